@@ -3,11 +3,14 @@
 """
 Control Flow Graphs (CFG)
 """
-import re
+from collections.abc import Mapping
 from typing import Iterator, List
 
 import tac
 from io import StringIO
+from symtab import SymbolTable
+import dataflow
+from dataflow import postorder
 
 # ------------------------------------------------------------------------------
 
@@ -228,11 +231,23 @@ class CFG:
 # ------------------------------------------------------------------------------
 
 
-_enders = re.compile(r'jmp|jz|jnz|jl|jle|jnl|jnle|ret')
-_jumps = re.compile(r'jmp|jz|jnz|jl|jle|jnl|jnle')
-_jcc = re.compile(r'jz|jnz|jl|jle|jnl|jnle')
-_jabs = re.compile(r'jmp|ret')
-_unconditional = re.compile(r'label|jmp|ret')
+_props = tac.opcode_props
+
+
+def _is_ender(opcode):
+    return _props.get(opcode, 0) & tac.OpProp.TERMINATOR
+
+
+def _is_jcc(opcode):
+    return _props.get(opcode, 0) & tac.OpProp.COND_JUMP
+
+
+def _is_jabs(opcode):
+    return _props.get(opcode, 0) & tac.OpProp.NO_FALLTHROUGH
+
+
+def _is_unconditional(opcode):
+    return opcode == 'label' or _is_jabs(opcode)
 
 
 def apply_label_rewrite(jinstr, tab):
@@ -263,9 +278,10 @@ class counter:
         return c
 
 
-def normalize_labels(tac_proc):
+def normalize_labels(tac_proc, rename=True):
     """Cleanup `tac_proc' to remove multiple entry labels, and renumber as
-    %.L0, %.L1, ..."""
+    %.L0, %.L1, ... Without `rename', every group of adjacent labels keeps
+    the first one instead."""
     labels = counter(transfn=lambda n: f'%.L{n}')
     norm_map = dict()
     instrs, tac_proc.body = tac_proc.body, []
@@ -275,7 +291,7 @@ def normalize_labels(tac_proc):
         cur += 1
         if instr.opcode == 'label':
             assert instr.arg1 not in norm_map
-            lab = next(labels)
+            lab = next(labels) if rename else instr.arg1
             tac_proc.body.append(tac.Instr(None, 'label', (lab, None)))
             norm_map[instr.arg1] = lab
             while cur < len(instrs) and instrs[cur].opcode == 'label':
@@ -285,6 +301,8 @@ def normalize_labels(tac_proc):
             tac_proc.body.append(instr)
     for instr in tac_proc.body:
         apply_label_rewrite(instr, norm_map)
+    tac_proc.invalidate_tables()
+    return norm_map
 
 
 def fallthrough_to_jump(tac_proc):
@@ -293,7 +311,7 @@ def fallthrough_to_jump(tac_proc):
     instrs, tac_proc.body = tac_proc.body, []
     for cur, instr in enumerate(instrs):
         tac_proc.body.append(instr)
-        if (not _unconditional.fullmatch(instr.opcode) and
+        if (not _is_unconditional(instr.opcode) and
             cur + 1 < len(instrs) and
                 instrs[cur + 1].opcode == 'label'):
             tac_proc.body.append(
@@ -312,29 +330,31 @@ def add_admin_labels(tac_proc):
         instr = instrs[cur]
         tac_proc.body.append(instr)
         cur += 1
-        if _jcc.fullmatch(instr.opcode):
+        if _is_jcc(instr.opcode):
             # skip conditional jump sequences
             while cur < len(instrs):
                 instr = instrs[cur]
-                if not _jcc.fullmatch(instr.opcode):
+                if not _is_jcc(instr.opcode):
                     break
                 tac_proc.body.append(instr)
                 cur += 1
             # skip unconditional jump
             instr = instrs[cur]
-            if _jabs.fullmatch(instr.opcode):
+            if _is_jabs(instr.opcode):
                 tac_proc.body.append(instr)
                 cur += 1
             tac_proc.body.append(
                 tac.Instr(None, 'label', (next(admin_labels), None)))
 
 
-def infer(tac_proc):
-    """Return a CFG inferred from the proc"""
+def infer(tac_proc, rename=True):
+    """Return a CFG inferred from the proc. The CFG records in `label_map'
+    the new name of every label of the original proc. Without `rename',
+    the blocks keep the labels of the proc (see `normalize_labels')."""
     # First bring it into a canonical form
     add_admin_labels(tac_proc)
     fallthrough_to_jump(tac_proc)
-    normalize_labels(tac_proc)
+    label_map = normalize_labels(tac_proc, rename)
     assert len(tac_proc.body) > 0
     assert tac_proc.body[0].opcode == 'label'
     lab_entry = tac_proc.body[0].arg1
@@ -347,52 +367,229 @@ def infer(tac_proc):
         cur += 1
         while cur < len(tac_proc.body):
             instr = tac_proc.body[cur]
-            if _enders.fullmatch(instr.opcode):
+            if _is_ender(instr.opcode):
                 break
             bl.body.append(instr)
             cur += 1
         while cur < len(tac_proc.body):
             instr = tac_proc.body[cur]
-            if not _enders.fullmatch(instr.opcode):
+            if not _is_ender(instr.opcode):
                 break
             bl.jumps.append(instr)
             cur += 1
         blocks.append(bl)
-    return CFG(tac_proc.name, lab_entry, blocks)
+    cfg = CFG(tac_proc.name, lab_entry, blocks)
+    cfg.label_map = label_map
+    # the passes over the cfg edit the instructions of the body in place
+    tac_proc.invalidate_tables()
+    return cfg
 
 # --------------------------------------------------------------------------------
 
 
-def linearize(tac_proc, cfg):
-    seen = set()
+_inverse_jcc = {'jz': 'jnz', 'jnz': 'jz', 'jl': 'jnl', 'jnl': 'jl',
+                'jle': 'jnle', 'jnle': 'jle'}
+
+
+def reachable(cfg):
+    """Labels of the blocks reachable from the entry, in DFS preorder.
+    Successors are visited in the order of the blocks in the CFG."""
+    rank = {lab: i for i, lab in enumerate(cfg.blocks())}
+    order, seen = [], {cfg.lab_entry}
     wl = [cfg.lab_entry]
-    schedule = []
-
-    def emit(bl):
-        nonlocal schedule
-        schedule.append(tac.Instr(None, 'label', (bl.label, None)))
-        for instr in bl.instrs():
-            schedule.append(instr)
-    ret_wl = []
-    while len(wl) > 0:
+    while wl:
         cur = wl.pop()
-        if cur in seen:
+        order.append(cur)
+        for lab in sorted(cfg.successors(cur), key=rank.get, reverse=True):
+            if lab not in seen:
+                seen.add(lab)
+                wl.append(lab)
+    return order
+
+
+def loop_depths(cfg):
+    """Return a dict mapping every block reachable from the entry to the
+    number of natural loops that contain it. Loops are found from the
+    back edges of a DFS from the entry; the loops of back edges that
+    share a header count as one."""
+    rank = {lab: i for i, lab in enumerate(cfg.blocks())}
+    on_stack, done, back = set(), set(), []
+    stack = [(cfg.lab_entry, iter(sorted(cfg.successors(cfg.lab_entry), key=rank.get)))]
+    on_stack.add(cfg.lab_entry)
+    while stack:
+        cur, succs = stack[-1]
+        for lab in succs:
+            if lab in on_stack:
+                back.append((cur, lab))
+            elif lab not in done:
+                on_stack.add(lab)
+                stack.append((lab, iter(sorted(cfg.successors(lab), key=rank.get))))
+                break
+        else:
+            stack.pop()
+            on_stack.remove(cur)
+            done.add(cur)
+    loops = dict()
+    for latch, header in back:
+        body = loops.setdefault(header, {header})
+        wl = [latch]
+        while wl:
+            lab = wl.pop()
+            if lab in body: continue
+            body.add(lab)
+            wl.extend(cfg.predecessors(lab))
+    depths = {lab: 0 for lab in done}
+    for body in loops.values():
+        for lab in body:
+            if lab in depths: depths[lab] += 1
+    return depths
+
+
+def profile_freqs(profile, proc_name, label_map=None):
+    """Return the edge frequencies of the proc `proc_name' recorded in a
+    profile written by tacvm (see tacvm.Machine.profile_data) as a dict
+    (from, to) -> count, or None if the proc was never called. The
+    labels are renamed with `label_map' if given (see `infer')."""
+    data = profile['procs'].get(proc_name)
+    if data is None: return None
+    label_map = label_map or dict()
+    freqs = dict()
+    for lab_from, lab_to, n in data['edges']:
+        if lab_from == proc_name: continue
+        key = (label_map.get(lab_from, lab_from), label_map.get(lab_to, lab_to))
+        freqs[key] = freqs.get(key, 0) + n
+    return freqs
+
+
+def layout(cfg, freqs=None, depths=None):
+    """Return the labels of the blocks reachable from the entry in the
+    order in which they should be emitted.
+
+    The blocks are chained so that the hottest edges become fallthroughs.
+    Only the edges that a block can fall through to are candidates: the
+    target of its final `jmp', or that of a single conditional jump
+    followed by a `jmp' (see `linearize'). Edges are weighted by
+    `freqs', a dict (from, to) -> count such as the one returned by
+    `profile_freqs', and then by 10^d where d is the loop depth of the
+    shallowest end of the edge. `depths' can give the result of
+    `loop_depths' if it is already known."""
+    order = reachable(cfg)
+    rank = {lab: i for i, lab in enumerate(order)}
+    depths = depths or loop_depths(cfg)
+    freqs = freqs or dict()
+
+    def weight(edge):
+        static = 10 ** min(depths[edge[0]], depths[edge[1]])
+        return (freqs.get(edge, 0), static)
+    candidates = []
+    for lab in order:
+        jumps = cfg[lab].jumps
+        if jumps and jumps[-1].opcode == 'jmp':
+            candidates.append((lab, jumps[-1].arg1))
+        if len(jumps) == 2 and jumps[0].opcode in _inverse_jcc and \
+                jumps[1].opcode == 'jmp':
+            candidates.append((lab, jumps[0].arg2))
+    candidates.sort(key=lambda e: (tuple(-w for w in weight(e)),
+                                   rank[e[0]], rank[e[1]]))
+    # merge the chains greedily, hottest edge first
+    chain = {lab: [lab] for lab in order}
+    for lab_from, lab_to in candidates:
+        c_from, c_to = chain[lab_from], chain[lab_to]
+        if lab_to == cfg.lab_entry or c_from is c_to or \
+                c_from[-1] != lab_from or c_to[0] != lab_to:
             continue
-        if cfg.out_degree(cur) == 0:
-            # delay rets to end
-            ret_wl.append(cur)
+        c_from.extend(c_to)
+        for lab in c_to:
+            chain[lab] = c_from
+    # emit the chains, starting from the entry, in the order in which they
+    # are reached from the blocks already placed
+    schedule, placed = [], set()
+
+    def place(lab):
+        if id(chain[lab]) in placed: return
+        placed.add(id(chain[lab]))
+        schedule.extend(chain[lab])
+    place(cfg.lab_entry)
+    cur = 0
+    while cur < len(schedule):
+        lab = schedule[cur]
+        cur += 1
+        succs = sorted(cfg.successors(lab),
+                       key=lambda s: (tuple(-w for w in weight((lab, s))), rank[s]))
+        for succ in succs:
+            place(succ)
+    return schedule
+
+
+def _starts_with_phi(bl):
+    return bool(bl.body) and bl.body[0].opcode == 'phi'
+
+
+def bypass_empty_blocks(cfg, freqs=None):
+    """Remove the blocks other than the entry that only hold a `jmp' to a
+    block starting with phis, by making their predecessors jump there
+    directly. The phi arguments of the removed block are moved to its
+    predecessors. A block is kept if one of its predecessors already
+    jumps to the target, since the phis could not tell them apart. Such
+    a block could not fall through into the phis (see `linearize'), so
+    its `jmp' would be executed on every pass. Returns `freqs' with the
+    counts of the removed edges moved to the new ones."""
+    freqs = dict(freqs or ())
+    for bl in list(cfg.nodes()):
+        lab = bl.label
+        if lab == cfg.lab_entry or bl.body or len(bl.jumps) != 1 or \
+                bl.jumps[0].opcode != 'jmp':
             continue
-        seen.add(cur)
-        bl = cfg[cur]
-        emit(bl)
-        wl.extend(cfg.successors(cur))
-    while len(ret_wl) > 0:
-        cur = ret_wl.pop()
-        if cur in seen:
+        target = bl.jumps[0].arg1
+        if target == lab or not _starts_with_phi(cfg[target]): continue
+        preds = list(cfg.predecessors(lab))
+        if lab in preds or any(target in cfg._fwd[pred] for pred in preds):
             continue
-        seen.add(cur)
-        emit(cfg[cur])
-    tac_proc.body = schedule
+        for instr in cfg[target].body:
+            if instr.opcode != 'phi': break
+            args = dict(instr.arg1)
+            if lab in args:
+                t = args.pop(lab)
+                args.update((pred, t) for pred in preds)
+            instr.arg1 = args
+        for pred in preds:
+            for jmp in cfg[pred].jumps:
+                if jmp.opcode == 'jmp' and jmp.arg1 == lab: jmp.arg1 = target
+                elif jmp.opcode in _inverse_jcc and jmp.arg2 == lab: jmp.arg2 = target
+            cfg.add_edge(pred, target)
+            count = freqs.get((pred, lab), 0) + freqs.get((pred, target), 0)
+            if count: freqs[(pred, target)] = count
+        cfg.remove_node(bl)
+    return freqs
+
+
+def linearize(tac_proc, cfg, freqs=None, depths=None):
+    """Replace the body of `tac_proc' with the blocks of `cfg' reachable
+    from its entry, laid out by `layout'. The empty blocks that only
+    lead to phis are removed first (see `bypass_empty_blocks'). Jumps to
+    the block that immediately follows are dropped, and a conditional
+    jump followed by a `jmp' is inverted when its own target follows."""
+    freqs = bypass_empty_blocks(cfg, freqs)
+    schedule = layout(cfg, freqs, depths)
+    body = []
+    for i, lab in enumerate(schedule):
+        bl = cfg[lab]
+        nxt = schedule[i + 1] if i + 1 < len(schedule) else None
+        jumps = bl.jumps
+        if jumps and jumps[-1].opcode == 'jmp' and jumps[-1].arg1 == nxt:
+            # an empty block cannot fall through into phis: its label would
+            # join the group of labels of the next block
+            if bl.body or len(jumps) > 1 or not _starts_with_phi(cfg[nxt]):
+                jumps = jumps[:-1]
+        elif len(jumps) == 2 and jumps[0].opcode in _inverse_jcc and \
+                jumps[1].opcode == 'jmp' and jumps[0].arg2 == nxt:
+            jcc = jumps[0]
+            jumps = [tac.Instr(None, _inverse_jcc[jcc.opcode],
+                               (jcc.arg1, jumps[1].arg1))]
+        body.append(tac.Instr(None, 'label', (lab, None)))
+        body.extend(bl.body)
+        body.extend(jumps)
+    tac_proc.body = body
 
 # ------------------------------------------------------------------------------
 
@@ -406,42 +603,180 @@ def filter_liveset(lab, lset):
             yield x
 
 
+class _LiveMap(Mapping):
+    """Lazy mapping from the instructions of a CFG to their live sets"""
+
+    def __init__(self, lv, index):
+        self._lv = lv
+        self._index = index
+
+    def __getitem__(self, instr):
+        return self._lv._instr_sets(instr)[self._index]
+
+    def __iter__(self):
+        return iter(self._lv._block_of)
+
+    def __len__(self):
+        return len(self._lv._block_of)
+
+
+class Liveness(dataflow.Analysis):
+    """Liveness analysis of a CFG, solved at the level of blocks.
+
+    Every block is summarized by the temporaries it reads before writing
+    them (gen) and those it writes (kill), as bitsets over the IDs of a
+    symtab.SymbolTable. The block-level equations are solved by
+    dataflow.solve, and its statistics are kept in `stats'. `livein' and `liveout' map each
+    instruction to its set of live temporaries, as computed by
+    `recompute_liveness'; they are derived for a whole block the first
+    time one of its instructions is looked up.
+
+    The arguments of a phi are live only on the edge from their label:
+    they are tracked as separate (label, temporary) items until they
+    cross that edge."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.symtab = SymbolTable.for_cfg(cfg)
+        self._bits = dict()      # temporary or (label, temporary) -> bit
+        for tid, t in enumerate(self.symtab.temps):
+            self._bits[t] = 1 << tid
+        self._plain = (1 << len(self.symtab.temps)) - 1
+        self._pairs = []         # bit index - len(temps) -> (label, temporary)
+        self._pairs_of = dict()  # temporary -> bitset of its (label, temporary) items
+        self._pairs_from = dict() # label -> bitset of the items on edges from it
+        self._block_of = dict()  # instruction -> label
+        self._ukill = dict()     # instruction -> (use bits, kill bits)
+        self._cache = dict()     # label -> {instruction: (livein, liveout)}
+        self.gen, self.kill = dict(), dict()
+        for bl in cfg.nodes():
+            gen = kill = 0
+            for instr in bl.reversed_instrs():
+                self._block_of[instr] = bl.label
+                use, ikill = self._use_kill(instr)
+                gen = use | (gen & ~ikill)
+                kill |= ikill
+            self.gen[bl.label], self.kill[bl.label] = gen, kill
+        self._block_of = {i: self._block_of[i] for i in cfg.instrs()}
+        self._solve()
+        self.livein = _LiveMap(self, 0)
+        self.liveout = _LiveMap(self, 1)
+
+    def _bit(self, item):
+        bit = self._bits.get(item)
+        if bit is None:
+            # a (label, temporary) argument of a phi
+            bit = 1 << (len(self.symtab.temps) + len(self._pairs))
+            self._bits[item] = bit
+            self._pairs.append(item)
+            lab, t = item
+            self._pairs_of[t] = self._pairs_of.get(t, 0) | bit
+            self._pairs_from[lab] = self._pairs_from.get(lab, 0) | bit
+        return bit
+
+    def _use_kill(self, instr):
+        # The instructions of a block are visited backwards, so a (label,
+        # temporary) item that can be live after a definition of the
+        # temporary was interned before it: it is in the kill set. Items of
+        # other blocks only cross into this one as plain temporaries.
+        use = kill = 0
+        for u in instr.uses():
+            use |= self._bit(u)
+        for d in instr.defs():
+            kill |= self._bit(d) | self._pairs_of.get(d, 0)
+        self._ukill[instr] = (use, kill)
+        return use, kill
+
+    def _across(self, lab, bits):
+        """Items of `bits' that are live at the end of the block `lab':
+        the temporaries, and the phi arguments on edges from `lab'"""
+        result = bits & self._plain
+        pairs = bits & self._pairs_from.get(lab, 0)
+        base = len(self.symtab.temps)
+        while pairs:
+            low = pairs & -pairs
+            result |= self._bits[self._pairs[low.bit_length() - 1 - base][1]]
+            pairs ^= low
+        return result
+
+    def _solve(self):
+        res = dataflow.solve(self.cfg, self)
+        self.live_in, self.live_out = res.before, res.after
+        self.stats = res.stats
+
+    # the dataflow problem
+
+    forward = False
+
+    def transfer(self, lab, value):
+        return self.gen[lab] | (value & ~self.kill[lab])
+
+    def edge(self, lab_from, lab_to, value):
+        return self._across(lab_from, value)
+
+    def _instr_sets(self, instr):
+        lab = self._block_of[instr]
+        sets = self._cache.get(lab)
+        if sets is None:
+            sets = self._cache[lab] = self._expand(lab)
+        return sets[instr]
+
+    def _expand(self, lab):
+        """Live sets of the instructions of the block `lab'. Each set is
+        built from the one of the next instruction, as they only differ
+        by a few temporaries."""
+        sets = dict()
+        base, plain = len(self.symtab.temps), self._plain
+        live = self.live_out[lab]
+        out_bits, out_set = live, set(self.symtab.names(live))
+        in_bits, in_set = 0, set()
+        # phi arguments live before the current instruction, and their
+        # temporaries
+        pairs = pair_temps = 0
+        for instr in self.cfg[lab].reversed_instrs():
+            use, kill = self._ukill[instr]
+            live = use | (live & ~kill)
+            new_pairs = live >> base
+            if new_pairs != pairs:
+                if pairs & ~new_pairs:
+                    pair_temps = self._pair_temps(new_pairs)
+                else:
+                    pair_temps |= self._pair_temps(new_pairs & ~pairs)
+                pairs = new_pairs
+            # the phi arguments count as their temporary in livein
+            in_bits, in_set = self._update(in_bits, in_set, (live & plain) | pair_temps)
+            sets[instr] = (in_set, out_set)
+            out_bits, out_set = self._update(out_bits, out_set, self._across(lab, live))
+        return sets
+
+    def _pair_temps(self, pairs):
+        """Bitset of the temporaries of the phi arguments in `pairs', a
+        bitset over the indices of `_pairs'"""
+        result = 0
+        while pairs:
+            low = pairs & -pairs
+            result |= self._bits[self._pairs[low.bit_length() - 1][1]]
+            pairs ^= low
+        return result
+
+    def _update(self, old_bits, old_set, new_bits):
+        """Return `new_bits' and a new set of the temporaries in it"""
+        names = self.symtab.names
+        new_set = set(old_set)
+        new_set.difference_update(names(old_bits & ~new_bits))
+        new_set.update(names(new_bits & ~old_bits))
+        return new_bits, new_set
+
+
 def recompute_liveness(cfg, livein, liveout):
     """Perform liveness analysis on the given cfg, storing the results in `livein' and `liveout'.
-    Note: both `livein' and `liveout' are cleaned out before computing liveness."""
+    Note: both `livein' and `liveout' are cleaned out before computing liveness.
+    Use `Liveness' directly to only compute the live sets that are needed."""
     livein.clear()
     liveout.clear()
-    # initialize livein with the use sets
+    lv = Liveness(cfg)
     for i in cfg.instrs():
-        livein[i] = set(i.uses())
-        liveout[i] = set()
-    dirty = True
-
-    def update_livein(i, j_livein):
-        nonlocal dirty
-        old_count = len(livein[i])
-        old_set = str(livein[i])
-        i_defs = set(i.defs())
-        for x in j_livein:
-            if ((isinstance(x, tuple) and x[1] in i_defs) or
-                    x in i_defs):
-                continue
-            livein[i].add(x)
-        if old_count != len(livein[i]):
-            dirty = True
-    while dirty:
-        dirty = False
-        for (li, i, lj, j) in cfg.instr_pairs(labeled=True):
-            if li == lj:
-                update_livein(i, livein[j])
-            else:
-                update_livein(i, filter_liveset(li, livein[j]))
-    for li, i, lj, j in cfg.instr_pairs(labeled=True):
-        liveout[i].update(filter_liveset(li, livein[j]))
-    # fix the livein sets to remove tuples
-    for i, li in livein.items():
-        livein[i] = {x[1] if isinstance(x, tuple) else x
-                     for x in li}
+        livein[i], liveout[i] = lv.livein[i], lv.liveout[i]
 
 # ------------------------------------------------------------------------------
 
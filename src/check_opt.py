@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Check that the optimizer preserves the output of TAC programs
+
+Every FILE is run on the reference interpreter (tac.execute), then
+optimized by a pipeline of passes (see passes.py) and run again on the
+decoded engine (tacvm), which supports the immediates left by the
+passes. The two outputs must be the same.
+
+A .tac file can choose its pipeline and require that a pass did
+something, with comments at its top:
+
+    // passes: ssa,min,sccp
+    // expect: sccp jumps_folded
+
+The expectation holds when the statistic (see the `changes' of the
+pass) summed over the procs is nonzero, so that the file exercises the
+path of the pass it was written for. With --passes, only the outputs
+are compared.
+"""
+
+import contextlib
+import io
+import sys
+
+import tac
+import tacvm
+import cfg as cfglib
+from passes import DEFAULT_PIPELINE, PassManager, cache_of
+
+# ------------------------------------------------------------------------------
+
+
+def read_directives(fname):
+    """The pipeline and the expectations, as (pass, statistic) pairs,
+    given by the leading comments of `fname'"""
+    pipeline, expects = None, []
+    if not fname.endswith('.tac'): return pipeline, expects
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith('//'): break
+            key, _, value = line[2:].partition(':')
+            key, value = key.strip(), value.strip()
+            if key == 'passes':
+                pipeline = value
+            elif key == 'expect':
+                name, stat = value.split()
+                expects.append((name, stat))
+    return pipeline, expects
+
+
+def run(tac_list, execute):
+    """Output of the program `tac_list' run by `execute', followed by
+    the error that stopped it, if any"""
+    gvars, procs = dict(), dict()
+    for tlv in tac_list:
+        if isinstance(tlv, tac.Gvar): gvars[tlv.name] = tlv
+        else: procs[tlv.name] = tlv
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            execute(gvars, procs, '@main', ())
+    except Exception as e:
+        out.write(f'error: {type(e).__name__}: {e}\n')
+    return out.getvalue()
+
+
+def optimize(tac_list, pipeline):
+    """Optimize the procs of `tac_list' in place; returns the log of the
+    PassManager"""
+    pm = PassManager(pipeline)
+    for tlv in tac_list:
+        if isinstance(tlv, tac.Proc):
+            cfg = pm.run(tlv, cfglib.infer(tlv))
+            cfglib.linearize(tlv, cfg, None, cache_of(cfg).get('loops'))
+    return pm.log
+
+
+def check(fname, pipeline=None):
+    """Return the list of the problems found with `fname'. The
+    expectations of the file are only checked with its own pipeline."""
+    directives, expects = read_directives(fname)
+    if pipeline: expects = []
+    pipeline = pipeline or directives or DEFAULT_PIPELINE
+    expected = run(tac.load_tac(fname), tac.execute)
+    tac_list = tac.load_tac(fname)
+    try:
+        log = optimize(tac_list, pipeline)
+    except Exception as e:
+        return [f'{pipeline} failed: {type(e).__name__}: {e}']
+    problems = []
+    got = run(tac_list, tacvm.execute)
+    if got != expected:
+        problems.append(f'output differs with {pipeline}:\n'
+                        f'--- expected\n{expected}--- got\n{got}')
+    for name, stat in expects:
+        total = sum(entry['stats'].get(stat, 0) for entry in log
+                    if entry['pass'] == name)
+        if not total:
+            problems.append(f'{name} did not report any {stat}')
+    return problems
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Compare the output of TAC programs '
+                                    'before and after optimization')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='+',
+                    help='A TAC file (.tac or .tac.json)')
+    ap.add_argument('--passes', dest='passes', default=None,
+                    help='Pipeline to use instead of the one of each file '
+                         f'(default: {DEFAULT_PIPELINE})')
+    args = ap.parse_args()
+    failed = 0
+    for fname in args.files:
+        problems = check(fname, args.passes)
+        print(f'{"FAIL" if problems else "ok"} {fname}')
+        for problem in problems:
+            print('  ' + problem.replace('\n', '\n  '))
+        failed += bool(problems)
+    sys.exit(1 if failed else 0)
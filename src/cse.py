@@ -1,13 +1,15 @@
 import argparse
+import json
 import sys
 from collections import defaultdict
 from os import name
 from typing import Generator
 
 from cfg import CFG, Block, infer, linearize
-from dom_tree import compute_dom_tree
-from sccp import binops, unops
-from tac import Instr, Proc, load_tac
+from dataflow import AvailableExpressions, expr_key, solve
+from dom_tree import DomTree, compute_dom_tree
+from ssagen import pruned_ssagen
+from tac import Instr, OpProp, Proc, binops, load_tac, opcode_props, unops
 
 
 def expr_map_block(block: Block) -> dict:
@@ -59,13 +61,18 @@ def partition(values: list, indices: list) -> Generator:
 
 
 def available_expr(cfg: CFG) -> dict:
-    """For each block, calculate the set of instructions
-    available when exiting the block"""
+    """For each block, map the expressions that it computes and that are
+    still available when exiting it (see dataflow.AvailableExpressions)
+    to the index of the last instruction computing them, provided that
+    its destination is not redefined afterwards"""
+    ae = AvailableExpressions(cfg)
+    avail_at_exit = solve(cfg, ae).after
     avail_expr_map = {}
     for label, block in cfg._blockmap.items():
         avail_expr_map[label] = dict()
+        available = set(ae.expressions(avail_at_exit[label]))
         for idx, instr in enumerate(block.instrs()):
-            if instr.opcode in binops or instr.opcode in unops:
+            if expr_key(instr) in available:
                 if idx >= max(find_redefinitions(block, instr.dest)):
                     avail_expr_map[label][(
                         instr.opcode, instr.arg1, instr.arg2 if instr.arg2 else None)] = idx
@@ -89,18 +96,29 @@ def local_cse(block: Block):
                                                  block[sublist[0]].dest])
 
 
-def global_cse(cfg: CFG) -> CFG:
+def global_cse(cfg: CFG, walk_dom_tree=False) -> CFG:
     """Apply common subexpression elimination
-    to the cfg. We assume local cse has already been applied"""
+    to the cfg. We assume local cse has already been applied.
+
+    With `walk_dom_tree', the expressions of a block are looked up in
+    all of its strict dominators, nearest first, rather than only in
+    its dominating direct predecessors. This is only correct in SSA
+    form, where temporaries are never redefined, so the expressions
+    that use globals are then left alone."""
 
     # Compute the dominator tree and mapping from expressions to instructions
     # as well as the available expressions at the end of each block
-    dom = compute_dom_tree(cfg)
+    if walk_dom_tree:
+        tree = DomTree(cfg)
+        dom = {label: tree.dominators(label) for label in cfg.blocks()}
+    else:
+        dom = compute_dom_tree(cfg)
     expr_map = expr_map_cfg(cfg)
     avail_expr_map = available_expr(cfg)
 
     # Loop over the blocks
     for block in expr_map:
+        replaced = set()
         # Loop over the blocks dominating the block
         for dom_block in dom[block]:
             # Loop over the expressions in the dominator block
@@ -108,7 +126,10 @@ def global_cse(cfg: CFG) -> CFG:
                 # Loop over the expressions in the block
                 for expr, instr_indices in expr_map[block].items():
                     # If the expressions are the same
-                    if dom_expr == expr:
+                    if dom_expr == expr and expr not in replaced:
+                        if walk_dom_tree and any(isinstance(arg, str) and arg.startswith('@')
+                                                 for arg in expr[1:]):
+                            continue
                         # Check for redefinitions
                         redefinitions = find_redefinitions(cfg._blockmap[block], expr[1])
                         if expr[2]:
@@ -116,9 +137,124 @@ def global_cse(cfg: CFG) -> CFG:
                         # Only replace the first expression as local cse already applied
                         if not redefinitions or min(redefinitions) > min(instr_indices):
                             cfg._blockmap[block][min(instr_indices)] = Instr(cfg._blockmap[block][min(instr_indices)].dest, 'copy', [cfg._blockmap[dom_block][dom_instr_idx].dest])
+                            replaced.add(expr)
+
+
+
+def is_ssa(cfg: CFG, tree: DomTree = None) -> bool:
+    """Whether the cfg is in strict SSA form: every local temporary is
+    defined at most once, before its uses in the same block or in a
+    block that dominates them (phi arguments are not checked)"""
+    tree = tree or DomTree(cfg)
+    defined = dict()
+    for label, block in cfg.items():
+        for index, instr in enumerate(block.instrs()):
+            if instr.dest and instr.dest.startswith('%'):
+                if instr.dest in defined: return False
+                defined[instr.dest] = (label, index)
+    for label, block in cfg.items():
+        if label not in tree: continue
+        for index, instr in enumerate(block.instrs()):
+            if instr.opcode == 'phi': continue
+            for t in instr.uses():
+                where = defined.get(t)
+                if where is None: continue
+                if where[0] == label:
+                    if where[1] >= index: return False
+                elif not tree.strictly_dominates(where[0], label):
+                    return False
+    return True
+
+
+def _operand_key(arg):
+    # immediates and temporaries can both be operands: sort them apart
+    return (isinstance(arg, str), arg)
 
-def apply_cse(cfg: CFG) -> CFG:
-    """Given a cfg, first apply local cse then global cse"""
+
+def gvn(cfg: CFG, stats=None, tree: DomTree = None) -> CFG:
+    """Global value numbering of a cfg in SSA form, in one walk of its
+    dominator tree.
+
+    Every temporary gets a value number: the temporary that first
+    computed its value in a dominating block. Copies take the number of
+    their source. An instruction is keyed by its opcode and the numbers
+    of its operands, sorted if the opcode is commutative. When the key is
+    already in the table of the dominating blocks, the instruction is
+    replaced by a copy of the temporary that computed it first. Phis of
+    the same block with the same arguments are merged the same way.
+    Expressions of globals are left alone, since globals are not
+    renamed."""
+    tree = tree or DomTree(cfg)
+    vn = dict()
+    value = lambda arg: vn.get(arg, arg)
+    table = dict()
+    counts = {'replaced': 0, 'values': 0}
+
+    def number(label):
+        added = []
+        merged_phi = False
+        block = cfg[label]
+        for index, instr in enumerate(block.body):
+            dest, opcode = instr.dest, instr.opcode
+            if not (dest and dest.startswith('%')): continue
+            props = opcode_props.get(opcode, 0)
+            if opcode == 'copy' and not str(instr.arg1).startswith('@'):
+                vn[dest] = value(instr.arg1)
+                continue
+            if opcode == 'phi':
+                key = ('phi', label) + tuple(sorted(
+                    (label_prev, _operand_key(value(t)))
+                    for label_prev, t in instr.arg1.items()))
+            elif opcode == 'const':
+                key = ('const', instr.arg1)
+            elif props & (OpProp.BINOP | OpProp.UNOP):
+                args = [instr.arg1] if props & OpProp.UNOP else [instr.arg1, instr.arg2]
+                if any(isinstance(arg, str) and arg.startswith('@') for arg in args):
+                    continue
+                args = [_operand_key(value(arg)) for arg in args]
+                if props & OpProp.COMMUTATIVE: args.sort()
+                key = (opcode, *args)
+            else:
+                continue
+            leader = table.get(key)
+            if leader is None:
+                table[key] = dest
+                added.append(key)
+                counts['values'] += 1
+            else:
+                vn[dest] = leader
+                block.body[index] = Instr(dest, 'copy', [leader])
+                counts['replaced'] += 1
+                merged_phi |= opcode == 'phi'
+        if merged_phi:
+            # the copies of merged phis go after the remaining ones
+            block.body.sort(key=lambda instr: instr.opcode != 'phi')
+        return added
+
+    # the unreachable blocks are numbered on their own
+    starts = [label for label in cfg.blocks() if label not in tree]
+    starts.append(tree.entry)
+    for start in starts:
+        work = [(start, None)]
+        while work:
+            label, added = work.pop()
+            if added is not None:
+                for key in added: del table[key]
+                continue
+            work.append((label, number(label)))
+            work.extend((kid, None) for kid in reversed(tree.children.get(label, ())))
+    if stats is not None:
+        stats.update(counts)
+    return cfg
+
+
+def apply_cse(cfg: CFG, stats=None, tree: DomTree = None) -> CFG:
+    """Given a cfg in SSA form, apply global value numbering, which
+    subsumes local and global cse. Otherwise, first apply local cse then
+    global cse. `tree' can give the DomTree of the cfg."""
+    tree = tree or DomTree(cfg)
+    if is_ssa(cfg, tree):
+        return gvn(cfg, stats, tree)
     for block in cfg._blockmap.values():
         local_cse(block)
     global_cse(cfg)
@@ -132,6 +268,10 @@ if __name__ == "__main__":
     ap.add_argument('fname', metavar='FILE', type=str, nargs=1,
                     help='The BX(JSON) file to process')
     ap.add_argument('-o', '--output', dest='output', type=str)
+    ap.add_argument('--ssa', dest='ssa', action='store_true', default=False,
+                    help='Convert to SSA first, so that value numbering is used')
+    ap.add_argument('-v', dest='verbosity', default=0, action='count',
+                    help='print the statistics of value numbering')
     opts = ap.parse_args(sys.argv[1:])
     fname = opts.fname[0]
 
@@ -145,7 +285,15 @@ if __name__ == "__main__":
     for count, decl in enumerate(tac_list):
         if isinstance(decl, Proc):
             cfg = infer(decl)
-            for block in cfg._blockmap.values():
-                local_cse(block)
-            global_cse(cfg)
+            if opts.ssa:
+                pruned_ssagen(decl, cfg)
+            stats = dict()
+            apply_cse(cfg, stats)
+            if opts.verbosity and stats:
+                print(f'// {decl.name}: {stats}', file=sys.stderr)
             linearize(decl, cfg)
+
+    # Write the output file if requested
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump([decl.js_obj for decl in tac_list], f)
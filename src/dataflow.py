@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""
+Worklist dataflow analyses over a CFG
+
+An analysis is a subclass of `Analysis' that gives the direction of the
+problem, the initial values, the meet of two values and the transfer
+function of a block (and optionally of an edge). `solve' then computes
+the fixpoint with a worklist in which the blocks are ordered by reverse
+postorder (postorder for backward problems), so that most blocks are
+visited after their inputs.
+
+Values can be anything, but bitsets (Python ints) over some numbering
+of the facts are the fastest: see `GenKill'.
+
+This module only relies on the interface of cfg.CFG (blocks, successors,
+predecessors, lab_entry, nodes) so that cfg.py can build on it.
+"""
+
+import heapq
+
+import tac
+
+# ------------------------------------------------------------------------------
+
+
+def postorder(cfg):
+    """Labels of the blocks in postorder of a DFS from the entry, followed
+    by the unreachable blocks. Reversed, this is a reverse postorder."""
+    rank = {lab: i for i, lab in enumerate(cfg.blocks())}
+    order, seen = [], {cfg.lab_entry}
+    stack = [(cfg.lab_entry, iter(sorted(cfg.successors(cfg.lab_entry), key=rank.get)))]
+    while stack:
+        cur, succs = stack[-1]
+        for lab in succs:
+            if lab not in seen:
+                seen.add(lab)
+                stack.append((lab, iter(sorted(cfg.successors(lab), key=rank.get))))
+                break
+        else:
+            stack.pop()
+            order.append(cur)
+    order.extend(lab for lab in cfg.blocks() if lab not in seen)
+    return order
+
+
+def reverse_postorder(cfg):
+    order = postorder(cfg)
+    order.reverse()
+    return order
+
+
+class Analysis:
+    """A dataflow problem. The defaults describe a forward may-problem
+    over bitsets whose values start empty."""
+
+    forward = True
+
+    def boundary(self):
+        """Value at the start of the entry block (forward) or at the end
+        of the blocks without successors (backward)"""
+        return 0
+
+    def top(self):
+        """Initial value of the blocks, and the identity of `meet'"""
+        return 0
+
+    def meet(self, a, b):
+        return a | b
+
+    def transfer(self, lab, value):
+        """Value at the other end of the block `lab', given the value at
+        its start (forward) or end (backward)"""
+        raise NotImplementedError
+
+    def edge(self, lab_from, lab_to, value):
+        """Value that flows along the edge `lab_from' -> `lab_to'. `value'
+        is the value at the end of `lab_from' (forward) or at the start
+        of `lab_to' (backward)."""
+        return value
+
+
+class Result:
+    """Solution of a dataflow problem: `before' and `after' map each
+    label to the value at the start and at the end of its block, in
+    program order whatever the direction. `stats' counts the passes
+    over the worklist order (`iterations') and the transfer function
+    applications (`visits')."""
+
+    def __init__(self):
+        self.before = dict()
+        self.after = dict()
+        self.stats = {'blocks': 0, 'iterations': 0, 'visits': 0}
+
+
+def solve(cfg, analysis):
+    """Solve `analysis' over `cfg' and return its Result"""
+    forward = analysis.forward
+    order = reverse_postorder(cfg) if forward else postorder(cfg)
+    rank = {lab: i for i, lab in enumerate(order)}
+    res = Result()
+    res.stats['blocks'] = len(order)
+    # `inp' is the value at the start of the analysis of each block (the
+    # start of the block when forward, its end when backward), `out' the
+    # one computed by its transfer function
+    if forward:
+        inp, out = res.before, res.after
+        sources, sinks = cfg.predecessors, cfg.successors
+    else:
+        inp, out = res.after, res.before
+        sources, sinks = cfg.successors, cfg.predecessors
+    top = analysis.top()
+    for lab in order:
+        inp[lab] = out[lab] = top
+    wl = [(i, lab) for i, lab in enumerate(order)]
+    queued = set(order)
+    last = len(order)
+    while wl:
+        i, lab = heapq.heappop(wl)
+        queued.discard(lab)
+        if i <= last:
+            res.stats['iterations'] += 1
+        last = i
+        value = top
+        srcs = list(sources(lab))
+        if (lab == cfg.lab_entry) if forward else not srcs:
+            value = analysis.boundary()
+        for src in srcs:
+            if forward:
+                value = analysis.meet(value, analysis.edge(src, lab, out[src]))
+            else:
+                value = analysis.meet(value, analysis.edge(lab, src, out[src]))
+        inp[lab] = value
+        new_out = analysis.transfer(lab, value)
+        res.stats['visits'] += 1
+        # every block starts on the worklist, so the sinks only need to be
+        # visited again if the value changes
+        if new_out != out[lab]:
+            out[lab] = new_out
+            for sink in sinks(lab):
+                if sink not in queued:
+                    queued.add(sink)
+                    heapq.heappush(wl, (rank[sink], sink))
+    return res
+
+
+class GenKill(Analysis):
+    """Bitset problem whose transfer functions are value -> gen | (value &
+    ~kill), with `gen' and `kill' given per block. A may-problem meets by
+    union; a must-problem by intersection, starting from `universe'."""
+
+    def __init__(self, gen, kill, forward=True, may=True, universe=0):
+        self.gen, self.kill = gen, kill
+        self.forward, self.may = forward, may
+        self.universe = universe
+
+    def top(self):
+        return 0 if self.may else self.universe
+
+    def meet(self, a, b):
+        return a | b if self.may else a & b
+
+    def transfer(self, lab, value):
+        return self.gen[lab] | (value & ~self.kill[lab])
+
+
+def bit_indices(bits):
+    """Indices of the bits set in `bits', in increasing order"""
+    result = []
+    while bits:
+        low = bits & -bits
+        result.append(low.bit_length() - 1)
+        bits ^= low
+    return result
+
+# ------------------------------------------------------------------------------
+# analyses
+
+
+class ReachingDefinitions(GenKill):
+    """Forward may-problem: the definitions that can reach each point.
+    Definitions are the instructions that define a temporary, numbered
+    in `defs'; the values are bitsets over these numbers."""
+
+    def __init__(self, cfg):
+        self.defs = []
+        defs_of = dict()
+        for instr in cfg.instrs():
+            for t in instr.defs():
+                defs_of[t] = defs_of.get(t, 0) | (1 << len(self.defs))
+                self.defs.append(instr)
+        gen, kill = dict(), dict()
+        i = 0
+        for bl in cfg.nodes():
+            g = k = 0
+            for instr in bl.instrs():
+                for t in instr.defs():
+                    g = (g & ~defs_of[t]) | (1 << i)
+                    k |= defs_of[t]
+                    i += 1
+            gen[bl.label], kill[bl.label] = g, k
+        super().__init__(gen, kill)
+
+    def definitions(self, bits):
+        return [self.defs[i] for i in bit_indices(bits)]
+
+
+def expr_key(instr):
+    """The expression computed by `instr' as (opcode, arg1, arg2), or None
+    if it is not an arithmetic instruction"""
+    if tac.opcode_props.get(instr.opcode, 0) & (tac.OpProp.BINOP | tac.OpProp.UNOP):
+        return (instr.opcode, instr.arg1, instr.arg2)
+    return None
+
+
+class AvailableExpressions(GenKill):
+    """Forward must-problem: the expressions (see `expr_key') computed on
+    every path to a point and whose operands were not redefined since.
+    The values are bitsets over the expressions numbered in `exprs'."""
+
+    def __init__(self, cfg):
+        self.exprs, ids = [], dict()
+        uses_of = dict()
+        for instr in cfg.instrs():
+            key = expr_key(instr)
+            if key is None or key in ids: continue
+            ids[key] = len(self.exprs)
+            self.exprs.append(key)
+            for arg in key[1:]:
+                if isinstance(arg, str):
+                    uses_of[arg] = uses_of.get(arg, 0) | (1 << ids[key])
+        gen, kill = dict(), dict()
+        for bl in cfg.nodes():
+            g = k = 0
+            for instr in bl.instrs():
+                key = expr_key(instr)
+                if key is not None: g |= 1 << ids[key]
+                for t in instr.defs():
+                    g &= ~uses_of.get(t, 0)
+                    k |= uses_of.get(t, 0)
+            gen[bl.label], kill[bl.label] = g, k
+        super().__init__(gen, kill, may=False,
+                         universe=(1 << len(self.exprs)) - 1)
+
+    def expressions(self, bits):
+        return [self.exprs[i] for i in bit_indices(bits)]
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import cfg as cfglib
+    ap = ArgumentParser(description='Run dataflow analyses on TAC procs')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='*',
+                    help='A TAC file (.tac or .tac.json)')
+    ap.add_argument('-v', dest='verbosity', default=0, action='count',
+                    help='increase verbosity')
+    args = ap.parse_args()
+    for srcfile in args.files:
+        for tlv in tac.load_tac(srcfile):
+            if not isinstance(tlv, tac.Proc): continue
+            cfg = cfglib.infer(tlv)
+            rd, ae = ReachingDefinitions(cfg), AvailableExpressions(cfg)
+            for name, an in (('reaching definitions', rd),
+                             ('available expressions', ae)):
+                res = solve(cfg, an)
+                print(f'// {tlv.name}: {name}: {res.stats}')
+                if args.verbosity == 0: continue
+                for lab in cfg.blocks():
+                    if an is rd:
+                        facts = [str(i).strip().rstrip(';') for i in rd.definitions(res.before[lab])]
+                    else:
+                        facts = [' '.join(map(str, e)) for e in ae.expressions(res.before[lab])]
+                    print(f'{lab}: {"; ".join(facts)}')
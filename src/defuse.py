@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Def-use index of a CFG in SSA form
+
+A DefUse maps every local temporary to the instruction that defines it
+and to the instructions that use it, phis included, so that a pass can
+visit or rewrite the uses of a temporary without scanning the whole
+CFG. It is built once after SSA construction and stays valid as long as
+the CFG is only changed through its mutation helpers (`replace_all_uses',
+`erase_instr' and `add_instr').
+
+Globals are not in SSA form and are not indexed.
+"""
+
+import tac
+
+# ------------------------------------------------------------------------------
+
+
+def is_local(thing):
+    """Whether `thing' is a local temporary (not a global or a label)"""
+    return isinstance(thing, str) and thing.startswith('%') and \
+        not thing.startswith('%.L')
+
+
+def phi_items(instr):
+    """(label, temporary) arguments of a phi, whichever form its arg1 has"""
+    # cfg.normalize_labels turns the arguments into (label, temp) pairs
+    return instr.arg1.items() if isinstance(instr.arg1, dict) else instr.arg1
+
+
+def operands(instr):
+    """Local temporaries read by `instr'"""
+    if instr.opcode == 'phi':
+        return [t for _, t in phi_items(instr) if is_local(t)]
+    return [t for t in instr.uses() if is_local(t)]
+
+
+class DefUse:
+    """Def-use index of `cfg'.
+
+    - defs: maps each local temporary to its defining instruction
+    - users: maps each local temporary to the instructions that read it,
+      as a dict used as an ordered set
+    - block_of: maps each instruction to the label of its block"""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.defs = dict()
+        self.users = dict()
+        self.block_of = dict()
+        for bl in cfg.nodes():
+            for instr in bl.instrs():
+                self._index(instr, bl.label)
+
+    def _index(self, instr, lab):
+        self.block_of[instr] = lab
+        if is_local(instr.dest):
+            self.defs[instr.dest] = instr
+        for t in operands(instr):
+            self.users.setdefault(t, dict())[instr] = None
+
+    # --------------------------------------------------------------------------
+    # queries
+
+    def definition(self, t):
+        """Instruction that defines `t', or None (arguments, undefined)"""
+        return self.defs.get(t)
+
+    def uses(self, t):
+        """Instructions that read `t'"""
+        return list(self.users.get(t, ()))
+
+    def has_uses(self, t):
+        return bool(self.users.get(t))
+
+    def __contains__(self, instr):
+        """Whether `instr' is (still) in the CFG"""
+        return instr in self.block_of
+
+    # --------------------------------------------------------------------------
+    # mutation
+
+    def add_instr(self, instr, lab):
+        """Index `instr', which the caller has put in the block `lab'"""
+        self._index(instr, lab)
+
+    def replace_all_uses(self, old, new):
+        """Make every instruction that reads `old' read `new' (a temporary
+        or an immediate) instead. Returns the number of instructions
+        changed."""
+        if old == new: return 0
+        users = self.users.pop(old, dict())
+        for instr in users:
+            if instr.opcode == 'phi':
+                if isinstance(instr.arg1, dict):
+                    for lab, t in instr.arg1.items():
+                        if t == old: instr.arg1[lab] = new
+                else:
+                    instr.arg1 = tuple((lab, new if t == old else t)
+                                       for lab, t in instr.arg1)
+            else:
+                if instr.arg1 == old: instr.arg1 = new
+                if instr.arg2 == old: instr.arg2 = new
+            if is_local(new):
+                self.users.setdefault(new, dict())[instr] = None
+        return len(users)
+
+    def erase_instr(self, instr):
+        """Remove `instr' from its block and from the index. The uses of
+        the temporary it defines, if any, are left to the caller."""
+        lab = self.block_of.pop(instr)
+        bl = self.cfg[lab]
+        if instr in bl.body:
+            bl.body.remove(instr)
+        else:
+            bl.jumps.remove(instr)
+        if is_local(instr.dest) and self.defs.get(instr.dest) is instr:
+            del self.defs[instr.dest]
+        for t in operands(instr):
+            users = self.users.get(t)
+            if users is not None:
+                users.pop(instr, None)
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import cfg as cfglib
+    from ssagen import pruned_ssagen
+    ap = ArgumentParser(description='Print the def-use index of TAC procs in SSA form')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='*',
+                    help='A TAC file (.tac or .tac.json)')
+    args = ap.parse_args()
+    for srcfile in args.files:
+        for tlv in tac.load_tac(srcfile):
+            if not isinstance(tlv, tac.Proc): continue
+            cfg = cfglib.infer(tlv)
+            pruned_ssagen(tlv, cfg)
+            du = DefUse(cfg)
+            print(f'proc {tlv.name}: {len(du.defs)} definitions')
+            for t in sorted(set(du.defs) | set(du.users)):
+                d = du.definition(t)
+                where = f'{du.block_of[d]}: {str(d).strip()}' if d else '(none)'
+                print(f'  {t}  def {where}  uses {len(du.uses(t))}')
@@ -1,37 +1,155 @@
 import argparse
 import os
 import sys
-from copy import deepcopy
 
-from cfg import CFG, infer
+import cfg as cfglib
+from cfg import CFG, infer, postorder
 from tac import Proc, load_tac
 
 
+class DomTree:
+    """Dominator tree of the blocks of a CFG reachable from its entry,
+    computed with the algorithm of Cooper, Harvey and Kennedy ("A Simple,
+    Fast Dominance Algorithm").
+
+    - idom: maps each block to its immediate dominator (None for the entry)
+    - children: maps each block to the blocks it immediately dominates
+    - pre, post: preorder and postorder numbers in the tree, with which
+      `dominates' is a constant time query"""
+
+    def __init__(self, cfg: CFG):
+        self.entry = cfg.lab_entry
+        reachable = set(cfglib.reachable(cfg))
+        order = [lab for lab in postorder(cfg) if lab in reachable]
+        po = {lab: i for i, lab in enumerate(order)}
+        idom = {self.entry: self.entry}
+
+        def intersect(a, b):
+            while a != b:
+                while po[a] < po[b]: a = idom[a]
+                while po[b] < po[a]: b = idom[b]
+            return a
+        changed = True
+        while changed:
+            changed = False
+            for lab in reversed(order):
+                if lab == self.entry: continue
+                new_idom = None
+                for pred in cfg.predecessors(lab):
+                    if pred not in idom: continue
+                    new_idom = pred if new_idom is None else intersect(pred, new_idom)
+                if idom.get(lab) != new_idom:
+                    idom[lab] = new_idom
+                    changed = True
+        idom[self.entry] = None
+        self.idom = idom
+        self.children = {lab: [] for lab in order}
+        for lab in reversed(order):
+            if idom[lab] is not None:
+                self.children[idom[lab]].append(lab)
+        self.pre, self.post = dict(), dict()
+        stack = [(self.entry, iter(self.children[self.entry]))]
+        self.pre[self.entry] = 0
+        while stack:
+            lab, kids = stack[-1]
+            for kid in kids:
+                self.pre[kid] = len(self.pre)
+                stack.append((kid, iter(self.children[kid])))
+                break
+            else:
+                stack.pop()
+                self.post[lab] = len(self.post)
+
+    def __contains__(self, lab):
+        return lab in self.idom
+
+    def dominates(self, a, b):
+        """Whether every path from the entry to `b' goes through `a'"""
+        if a not in self.pre or b not in self.pre: return False
+        return self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a]
+
+    def strictly_dominates(self, a, b):
+        return a != b and self.dominates(a, b)
+
+    def dominators(self, lab):
+        """Strict dominators of `lab', nearest first"""
+        result = []
+        lab = self.idom.get(lab)
+        while lab is not None:
+            result.append(lab)
+            lab = self.idom[lab]
+        return result
+
+    def preorder(self):
+        """Labels of the blocks in a preorder of the tree"""
+        return sorted(self.pre, key=self.pre.get)
+
+
+# Label of the virtual block that follows every block without successors
+EXIT = '%.exit'
+
+
+class ReverseCFG:
+    """View of a CFG with its edges reversed, entered at a virtual block
+    EXIT that leads to every block without successors. Its DomTree is the
+    postdominator tree of the CFG; the blocks from which no exit can be
+    reached are not in it."""
+
+    def __init__(self, cfg: CFG):
+        self.cfg = cfg
+        self.lab_entry = EXIT
+        self.exits = [lab for lab in cfg.blocks() if cfg.out_degree(lab) == 0]
+
+    def blocks(self):
+        return [EXIT] + list(self.cfg.blocks())
+
+    def successors(self, lab):
+        if lab == EXIT: return iter(self.exits)
+        return self.cfg.predecessors(lab)
+
+    def predecessors(self, lab):
+        if lab == EXIT: return iter(())
+        if self.cfg.out_degree(lab) == 0: return iter([EXIT])
+        return self.cfg.successors(lab)
+
+
+def dominance_frontiers(cfg: CFG, tree: DomTree = None):
+    '''Map each reachable block to its dominance frontier: the blocks
+    that it does not strictly dominate but one of whose predecessors it
+    dominates. Walks up the tree from the predecessors of every join, as
+    in Cooper, Harvey and Kennedy.'''
+    tree = tree or DomTree(cfg)
+    df = {lab: set() for lab in tree.idom}
+    for lab in tree.idom:
+        for pred in cfg.predecessors(lab):
+            runner = pred
+            while runner in tree and runner != tree.idom[lab]:
+                df[runner].add(lab)
+                runner = tree.idom[runner]
+    return df
+
+
+def iterated_frontier(df, labs):
+    '''The iterated dominance frontier of the blocks `labs' given their
+    frontiers `df': the blocks where definitions in `labs' meet'''
+    result = set()
+    work = list(labs)
+    while work:
+        for lab in df.get(work.pop(), ()):
+            if lab not in result:
+                result.add(lab)
+                work.append(lab)
+    return result
+
+
 def compute_dom_tree(cfg: CFG):
-    '''Given a control flow graph, compute the dominator
-    tree and return the map Dom: V->P(V)'''
-    dom_iter = {block: set() for block in cfg.blocks()}
-    dom_iter[cfg.lab_entry] = {cfg.lab_entry}
-    for v in cfg.blocks():
-        if v != cfg.lab_entry:
-            dom_iter[v] = set(cfg.blocks())
-    while True:
-        dom = deepcopy(dom_iter)
-        for v in cfg.blocks():
-            if v != cfg.lab_entry:
-                dom_iter[v] = {v} | set.intersection(
-                    *(dom[u] for u in cfg._bwd[v]))
-        if dom == dom_iter:
-            # Remove itself and nodes not directly above to obtain strict dominators only
-            for label in dom:
-                if label in dom[label]:
-                    dom[label].remove(label)
-                strict_doms = set()
-                for V in dom[label]:
-                    if V in cfg._bwd[label]:
-                        strict_doms.add(V)
-                    dom[label] = strict_doms
-            return dom
+    '''Given a control flow graph, return the map Dom: V->P(V) from
+    each block to those of its direct predecessors that strictly
+    dominate it (see DomTree for the actual tree)'''
+    tree = DomTree(cfg)
+    return {lab: {pred for pred in cfg.predecessors(lab)
+                  if tree.strictly_dominates(pred, lab)}
+            for lab in cfg.blocks()}
 
 
 if __name__ == "__main__":
@@ -56,6 +174,8 @@ if __name__ == "__main__":
             cfg = infer(decl)
             dom = compute_dom_tree(cfg)
             print(dom)
+            print(DomTree(cfg).idom)
+            print(dominance_frontiers(cfg))
 
             cfg.write_dot(fname + '.dot')
             os.system(f'dot -Tpdf -O {fname}.dot.{decl.name[1:]}.dot')
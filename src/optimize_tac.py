@@ -13,13 +13,60 @@ Returns:
 import sys
 import argparse
 import json
-from cfg import infer, linearize
-from ssagen import crude_ssagen
+import os
+from multiprocessing import Pool
+from cfg import infer, linearize, profile_freqs
 from tac import Proc, load_tac
-from sccp import optimize_sccp
-from ssa_min import minimize
-from cse import apply_cse
-from tac_doft import GCP
+from passes import DEFAULT_PIPELINE, PassManager, cache_of, parse_pipeline, passes
+from passes import format_summary, summarize
+
+# Below this many instructions in all, the procs are optimized in this
+# process even with -j, since starting the workers would take longer
+PARALLEL_MIN_INSTRS = 5000
+
+
+def optimize_proc(decl, pm, profile=None):
+    """Run the passes of the PassManager `pm' over the proc `decl' and
+    linearize the result back into `decl'"""
+    cfg = infer(decl)
+    freqs = profile and profile_freqs(profile, decl.name, cfg.label_map)
+    cfg = pm.run(decl, cfg)
+    linearize(decl, cfg, freqs, cache_of(cfg).get('loops'))
+
+
+# State of a worker process, set by _init_worker
+_worker = dict()
+
+
+def _init_worker(spec, measure, profile):
+    _worker['spec'] = spec
+    _worker['measure'] = measure
+    _worker['profile'] = profile
+
+
+def _optimize_job(job):
+    """Optimize the proc given as (index, JSON text) in a worker. Returns
+    the index, the JSON text of the result and the log of the passes."""
+    index, text = job
+    decl = Proc.load(json.loads(text))
+    pm = PassManager(_worker['spec'], measure=_worker['measure'])
+    optimize_proc(decl, pm, _worker['profile'])
+    return index, json.dumps(decl.js_obj), pm.log
+
+
+def optimize_parallel(procs, spec, measure, profile, jobs):
+    """Optimize the procs in a pool of `jobs' processes. The procs are
+    sent and returned as JSON text, the largest first so that the last
+    jobs are short, and the results are put back in the order of
+    `procs'. Returns the optimized procs and the concatenated logs of
+    their passes."""
+    order = sorted(range(len(procs)), key=lambda i: -len(procs[i].body))
+    jobs_args = [(i, json.dumps(procs[i].js_obj)) for i in order]
+    results = [None] * len(procs)
+    with Pool(jobs, _init_worker, (spec, measure, profile)) as pool:
+        for index, text, log in pool.imap_unordered(_optimize_job, jobs_args):
+            results[index] = (Proc.load(json.loads(text)), log)
+    return [decl for decl, _ in results], [e for _, log in results for e in log]
 
 if __name__ == "__main__":
     # Parse the command line arguments
@@ -29,8 +76,40 @@ if __name__ == "__main__":
                     help='The BX(JSON) file to process')
     ap.add_argument('-o', '--output', dest='output', type=str)
     ap.add_argument('-p', action='store_true', dest='print_cfg')
+    ap.add_argument('--profile', dest='profile', type=str,
+                    help='Profile of FILE written by tac.py --profile, used '
+                         'to lay out the blocks')
+    ap.add_argument('--ssa', dest='ssa', choices=('pruned', 'crude'),
+                    default='pruned',
+                    help='SSA construction: phis at the dominance frontiers '
+                         '(default) or for every live temporary of every block')
+    ap.add_argument('--passes', dest='passes', default=DEFAULT_PIPELINE,
+                    help=f'Comma separated passes among {", ".join(passes)} '
+                         f'(default: {DEFAULT_PIPELINE})')
+    ap.add_argument('--time-passes', dest='time_passes', action='store_true',
+                    default=False,
+                    help='Print the time, peak memory and IR size of every '
+                         'pass, summed over the procs, to stderr')
+    ap.add_argument('--stats', dest='stats', type=str,
+                    help='Write the measures of every pass on every proc, and '
+                         'their summary, to this JSON file')
+    ap.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='Optimize the procs in this many processes '
+                         '(0: one per CPU)')
     opts = ap.parse_args(sys.argv[1:])
+    spec = opts.passes
+    if opts.ssa == 'crude':
+        spec = ','.join('crude-ssa' if name.strip() == 'ssa' else name
+                        for name in spec.split(','))
+    try:
+        pipeline = parse_pipeline(spec)
+    except ValueError as e:
+        ap.error(str(e))
     fname = opts.fname[0]
+    profile = None
+    if opts.profile:
+        with open(opts.profile) as f:
+            profile = json.load(f)
 
     # Read the input file into tac
     try:
@@ -40,17 +119,30 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # Optimize the declarations
-    new_tac_list = []
-    for decl in tac_list:
-        if isinstance(decl, Proc):
-            cfg = infer(decl)
-            crude_ssagen(decl, cfg)
-            cfg = minimize(cfg)
-            cfg = optimize_sccp(cfg)
-            cfg = apply_cse(cfg)
-            cfg = GCP(cfg)
-            linearize(decl, cfg)
-            new_tac_list.append(decl)
+    pm = PassManager(pipeline, measure=opts.time_passes or bool(opts.stats))
+    procs = [decl for decl in tac_list if isinstance(decl, Proc)]
+    jobs = min(opts.jobs or os.cpu_count() or 1, len(procs))
+    if jobs > 1 and sum(len(decl.body) for decl in procs) >= PARALLEL_MIN_INSTRS:
+        optimized, pm.log = optimize_parallel(
+            procs, ','.join(p.name for p in pipeline), pm.measure, profile, jobs)
+        optimized = iter(optimized)
+        new_tac_list = [next(optimized) if isinstance(decl, Proc) else decl
+                        for decl in tac_list]
+    else:
+        for decl in procs:
+            optimize_proc(decl, pm, profile)
+        new_tac_list = tac_list
+
+    # Report the measures of the passes if requested
+    if pm.measure:
+        summary = summarize(pm.log)
+        if opts.time_passes:
+            print(format_summary(summary), file=sys.stderr)
+        if opts.stats:
+            with open(opts.stats, 'w') as f:
+                json.dump({'input': fname,
+                           'pipeline': [p.name for p in pipeline],
+                           'summary': summary, 'passes': pm.log}, f, indent=1)
 
     # Write the output file if requested
     if opts.output:
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""
+Pass manager over the CFG of a proc
+
+A pass declares the analyses it `requires', which it is given from the
+cache of the CFG, and those it `preserves' when it changes something.
+Analyses are only computed when a pass requires them and nothing in the
+cache is valid for the CFG anymore: after a pass that changed the CFG,
+every analysis that it does not preserve is dropped. Whether a pass
+changed anything is read from the statistics that it fills.
+
+Pipelines are lists of pass names, e.g. `ssa,min,sccp,cse,copyprop,adce'.
+"""
+
+import time
+import tracemalloc
+
+import tac
+import cfg as cfglib
+from defuse import DefUse, is_local, operands
+from dom_tree import DomTree
+from ssagen import crude_ssagen, pruned_ssagen
+from ssa_min import minimize
+from sccp import optimize_sccp
+from cse import apply_cse
+from tac_doft import copy_propagation, dce
+
+# ------------------------------------------------------------------------------
+# analyses
+
+# name -> function computing the analysis of a cfg
+analyses = {
+    'dominators': DomTree,
+    'liveness': cfglib.Liveness,
+    'defuse': DefUse,
+    'loops': cfglib.loop_depths,
+}
+
+
+class AnalysisCache:
+    """The analyses computed for `cfg' that are still valid. `stats'
+    counts the analyses computed and those reused from the cache."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.results = dict()
+        self.stats = {'computed': 0, 'reused': 0}
+
+    def get(self, name):
+        """Result of the analysis `name', computed if it is not cached"""
+        if name in self.results:
+            self.stats['reused'] += 1
+        else:
+            self.results[name] = analyses[name](self.cfg)
+            self.stats['computed'] += 1
+        return self.results[name]
+
+    def invalidate(self, preserved=()):
+        """Drop every analysis not in `preserved'"""
+        for name in list(self.results):
+            if name not in preserved:
+                del self.results[name]
+
+    def reset(self, cfg):
+        """Start over for `cfg', which replaces the cfg of the cache"""
+        self.cfg = cfg
+        self.results.clear()
+
+
+def cache_of(cfg):
+    """The AnalysisCache kept on `cfg', created if needed"""
+    cache = getattr(cfg, 'analyses', None)
+    if cache is None or cache.cfg is not cfg:
+        cache = cfg.analyses = AnalysisCache(cfg)
+    return cache
+
+# ------------------------------------------------------------------------------
+# passes
+
+
+class Pass:
+    """A transformation of the cfg of a proc.
+
+    - run: function (tlv, cfg, stats, **required analyses) -> cfg
+    - requires: names of the analyses given to `run' as keyword arguments
+    - preserves: names of the analyses still valid after `run' changed
+      the cfg
+    - changes: keys of `stats' that are nonzero when the cfg changed; a
+      pass that fills none of them (e.g. the fallbacks for a cfg not in
+      SSA form) is taken to have changed the cfg"""
+
+    def __init__(self, name, run, requires=(), preserves=(), changes=()):
+        self.name = name
+        self.run = run
+        self.requires = tuple(requires)
+        self.preserves = tuple(preserves)
+        self.changes = tuple(changes)
+
+    def changed(self, stats):
+        if not any(key in stats for key in self.changes): return True
+        return any(stats[key] for key in self.changes if key in stats)
+
+    def __repr__(self):
+        return f'Pass({self.name!r})'
+
+
+def _ssa(tlv, cfg, stats, liveness, dominators):
+    pruned_ssagen(tlv, cfg, liveness, dominators)
+    return cfg
+
+
+def _crude_ssa(tlv, cfg, stats, liveness):
+    crude_ssagen(tlv, cfg, liveness)
+    return cfg
+
+
+_SCCP_CHANGES = ('blocks_removed', 'jumps_folded', 'instrs_removed', 'uses_replaced')
+_DCE_CHANGES = ('instrs_removed', 'branches_removed', 'blocks_removed')
+
+# name -> Pass. Renaming temporaries and adding phis changes neither the
+# blocks nor the edges, so the dominators and loops survive SSA
+# construction; the passes that remove blocks or edges preserve nothing.
+passes = {p.name: p for p in [
+    Pass('ssa', _ssa, requires=('liveness', 'dominators'),
+         preserves=('dominators', 'loops')),
+    Pass('crude-ssa', _crude_ssa, requires=('liveness',),
+         preserves=('dominators', 'loops')),
+    Pass('min', lambda tlv, cfg, stats: minimize(cfg, scc=True, stats=stats),
+         preserves=('dominators', 'loops'), changes=('phis_removed',)),
+    Pass('sccp', lambda tlv, cfg, stats, defuse: optimize_sccp(cfg, stats, defuse),
+         requires=('defuse',), changes=_SCCP_CHANGES),
+    Pass('cse', lambda tlv, cfg, stats, dominators: apply_cse(cfg, stats, dominators),
+         requires=('dominators',), preserves=('dominators', 'loops'),
+         changes=('replaced',)),
+    Pass('copyprop', lambda tlv, cfg, stats, dominators:
+         copy_propagation(cfg, stats, dominators),
+         requires=('dominators',), preserves=('dominators', 'loops'),
+         changes=('copies_removed',)),
+    Pass('dce', lambda tlv, cfg, stats, defuse, dominators:
+         dce(cfg, False, stats, defuse, dominators),
+         requires=('defuse', 'dominators'), preserves=('dominators', 'loops'),
+         changes=_DCE_CHANGES),
+    Pass('adce', lambda tlv, cfg, stats, defuse, dominators:
+         dce(cfg, True, stats, defuse, dominators),
+         requires=('defuse', 'dominators'), changes=_DCE_CHANGES),
+]}
+
+DEFAULT_PIPELINE = 'ssa,min,sccp,cse,copyprop,adce'
+
+
+def parse_pipeline(spec):
+    """List of the Passes named in the comma separated `spec'. Raises
+    ValueError on an unknown name."""
+    result = []
+    for name in spec.split(','):
+        name = name.strip()
+        if not name: continue
+        if name not in passes:
+            raise ValueError(f'Unknown pass {name!r}, '
+                             f'expected one of {", ".join(passes)}')
+        result.append(passes[name])
+    return result
+
+# ------------------------------------------------------------------------------
+
+
+def ir_size(cfg):
+    """Size of the IR of `cfg': the numbers of instructions (jumps
+    included), phis, blocks and local temporaries"""
+    size = {'instrs': 0, 'phis': 0, 'blocks': 0, 'temps': 0}
+    temps = set()
+    for bl in cfg.nodes():
+        size['blocks'] += 1
+        for instr in bl.instrs():
+            size['instrs'] += 1
+            if instr.opcode == 'phi': size['phis'] += 1
+            if is_local(instr.dest): temps.add(instr.dest)
+            temps.update(operands(instr))
+    size['temps'] = len(temps)
+    return size
+
+
+class PassManager:
+    """Runs a list of Passes over the cfgs of procs. `log' gets one dict
+    per pass run: the proc, the pass, whether it changed the cfg, the
+    time it took (analyses included) and the statistics it filled.
+
+    With `measure', every entry also has the number of analyses the pass
+    had computed, the peak memory allocated while it ran (traced with
+    tracemalloc, which slows everything down) and the `ir_size' of the
+    cfg before and after it."""
+
+    def __init__(self, pipeline, measure=False):
+        if isinstance(pipeline, str):
+            pipeline = parse_pipeline(pipeline)
+        self.pipeline = list(pipeline)
+        self.measure = measure
+        self.log = []
+
+    def run(self, tlv, cfg):
+        """Run the pipeline over `cfg', the cfg of the proc `tlv', and
+        return the resulting cfg, whose cache holds the analyses that are
+        still valid"""
+        measure = self.measure
+        if measure and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        cache = cache_of(cfg)
+        for p in self.pipeline:
+            entry = {'proc': tlv.name, 'pass': p.name}
+            if measure:
+                entry['before'] = ir_size(cfg)
+                computed = cache.stats['computed']
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            stats = dict()
+            start = time.perf_counter()
+            required = {name: cache.get(name) for name in p.requires}
+            new_cfg = p.run(tlv, cfg, stats, **required)
+            entry['time'] = time.perf_counter() - start
+            if measure:
+                entry['peak_memory'] = tracemalloc.get_traced_memory()[1] - base
+                entry['analyses_computed'] = cache.stats['computed'] - computed
+            changed = p.changed(stats)
+            if new_cfg is not cfg:
+                cfg = new_cfg
+                cache = cache_of(cfg)
+                cache.reset(cfg)
+            elif changed:
+                cache.invalidate(p.preserves)
+            if measure:
+                entry['after'] = ir_size(cfg)
+            entry['changed'] = changed
+            entry['stats'] = stats
+            self.log.append(entry)
+        return cfg
+
+
+def summarize(log):
+    """Totals over the procs of the measured `log' of a PassManager, one
+    dict per pass in pipeline order: the time, the largest peak memory,
+    and the sums of the `ir_size' before and after the pass"""
+    totals = dict()
+    for entry in log:
+        total = totals.get(entry['pass'])
+        if total is None:
+            total = totals[entry['pass']] = {
+                'pass': entry['pass'], 'procs': 0, 'changed': 0, 'time': 0.0,
+                'peak_memory': 0, 'before': dict.fromkeys(entry['before'], 0),
+                'after': dict.fromkeys(entry['after'], 0)}
+        total['procs'] += 1
+        total['changed'] += entry['changed']
+        total['time'] += entry['time']
+        total['peak_memory'] = max(total['peak_memory'], entry['peak_memory'])
+        for key in ('before', 'after'):
+            for name, count in entry[key].items():
+                total[key][name] += count
+    return list(totals.values())
+
+
+def format_summary(summary):
+    """The `summarize'd totals as a table, one line per pass and a
+    line for the whole pipeline"""
+    sizes = ('instrs', 'phis', 'blocks', 'temps')
+    lines = [f'{"pass":<10} {"time(ms)":>9} {"peak(KiB)":>10} {"changed":>8}  ' +
+             '  '.join(f'{name:^15}' for name in sizes)]
+    for total in summary:
+        lines.append(f'{total["pass"]:<10} {total["time"] * 1000:>9.1f} '
+                     f'{total["peak_memory"] / 1024:>10.1f} '
+                     f'{total["changed"]:>3}/{total["procs"]:<4}  ' +
+                     '  '.join(f'{total["before"][name]:>7}>{total["after"][name]:<7}'
+                               for name in sizes))
+    if summary:
+        lines.append(f'{"total":<10} {sum(t["time"] for t in summary) * 1000:>9.1f} '
+                     f'{max(t["peak_memory"] for t in summary) / 1024:>10.1f}')
+    return '\n'.join(lines)
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Run a pipeline of passes over TAC procs')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='*',
+                    help='A TAC file (.tac or .tac.json)')
+    ap.add_argument('--passes', dest='passes', default=DEFAULT_PIPELINE,
+                    help=f'Comma separated passes among {", ".join(passes)} '
+                         f'(default: {DEFAULT_PIPELINE})')
+    ap.add_argument('--time-passes', dest='time_passes', action='store_true',
+                    default=False, help='Measure every pass and print a summary')
+    args = ap.parse_args()
+    for srcfile in args.files:
+        pm = PassManager(args.passes, measure=args.time_passes)
+        for tlv in tac.load_tac(srcfile):
+            if not isinstance(tlv, tac.Proc): continue
+            start = len(pm.log)
+            cfg = pm.run(tlv, cfglib.infer(tlv))
+            for entry in pm.log[start:]:
+                print(f'{entry["proc"]} {entry["pass"]}: '
+                      f'{"changed" if entry["changed"] else "unchanged"} '
+                      f'{entry["stats"]}')
+            print(f'{tlv.name} analyses: {cfg.analyses.stats}')
+        if args.time_passes:
+            print(format_summary(summarize(pm.log)))
@@ -2,11 +2,14 @@ import argparse
 import json
 import sys
 from enum import Enum, auto
-from typing import List, Union
+from typing import List
 
 from cfg import CFG, Block, infer, linearize
-from ssagen import crude_ssagen
-from tac import Gvar, Instr, Proc, execute, load_tac
+from ssagen import crude_ssagen, rewrite_use_temps_nonphi
+import tac
+from defuse import DefUse, is_local
+from tac import Gvar, Instr, Proc, load_tac
+import tacvm
 
 
 class Constants(Enum):
@@ -34,252 +37,258 @@ def fetch_temporaries(cfg: CFG):
     return list(temps)
 
 
-def initialize_conditions(cfg: CFG):
-    '''Initialise the maps Val and Ev'''
-    val = dict()
-    for v in fetch_temporaries(cfg):
-        if v and v[1].isalpha():
-            val[v] = Constants.non_constant
-        else:
-            val[v] = Constants.unused
-    for block in cfg._blockmap.values():
-        for instr in block.instrs():
-            if instr.opcode == 'ret' and instr.arg1:
-                val[instr.arg1] = Constants.non_constant
-
-    ev = {label: (True if label == cfg.lab_entry else False)
-          for label in cfg._blockmap}
-    return ev, val
-
-
-def check_jmp_condition(jmp_type: str, value: int):
-    if jmp_type == "jz":
-        return value == 0
-    elif jmp_type == "jnz":
-        return value != 0
-    elif jmp_type == "jl":
-        return value < 0
-    elif jmp_type == "jle":
-        return value <= 0
-    elif jmp_type == "jnl":
-        return value >= 0
-    elif jmp_type == "jnle":
-        return value > 0
-
-
-def update_ev(cfg: CFG, ev: dict, val: dict) -> bool:
-    '''Update the map ev and return true if any modifications 
-    are made'''
-
-    modified = False
-    for block, executed in ev.items():
-        definite_jmp = False  # Set to true when a definite jump is found
-        if executed:
-            for jmp in cfg._blockmap[block].reversed_jumps():
-
-                jmp_type = jmp.opcode
-
-                if jmp_type == "jmp" and not definite_jmp:
-                    dest_block = jmp.arg1
-
-                    modified |= update_dict(ev, dest_block, True)
-                elif jmp_type != "ret":
-
-                    value = val[jmp.arg1]
-                    dest_block = jmp.arg2
-
-                    if value is Constants.non_constant:
-                        modified |= update_dict(ev, dest_block, True)
-                    elif value is Constants.unused:
-                        break  # Stop further updates to this block
-                    else:  # Definite jump found
-                        if check_jmp_condition(jmp_type, value):
-                            modified |= update_dict(ev, dest_block, True)
-                            definite_jmp = True
-                        else:
-                            # FIXME: This may not be correct
-                            pass
-    return modified
-
-
-def update_dict(d: dict, key: str, val: Union[str, Constants, bool]):
-    '''Make an update to the dictionaries ev or val and return true
-    if the dictionary was modified'''
-    old_value = d[key]
-    d[key] = val
-    return old_value != val
-
-
-binops = {
-    'add': (lambda u, v: u + v),
-    'sub': (lambda u, v: u - v),
-    'mul': (lambda u, v: u * v),
-    'div': (lambda u, v: u / v),
-    'mod': (lambda u, v: u - v * int(u / v)),
-    'and': (lambda u, v: u & v),
-    'or': (lambda u, v: u | v),
-    'xor': (lambda u, v: u ^ v),
-    'shl': (lambda u, v: u << v),
-    'shr': (lambda u, v: u >> v),
-}
-unops = {
-    'neg': (lambda u: -u),
-    'not': (lambda u: ~u),
-}
-
-
-def update_dest(instr: Instr, dest: str, val: dict):
-    '''Make an update to the dictionary val based on the instruction
-    and return true if the dictionary was modified'''
-    old_value = val[dest]
-    if instr.opcode in binops:
-        val[dest] = binops[instr.opcode](
-            int(val[instr.arg1]), int(val[instr.arg2]))
-    elif instr.opcode == 'const':
-        val[dest] = instr.arg1
-    elif instr.opcode in unops:
-        val[dest] = unops[instr.opcode](int(val[instr.arg1]))
-    return old_value != val[dest]
-
-
-def update_val(cfg: CFG, ev: dict, val: dict) -> bool:
-    '''Update the map val and return true if any modifications
-    are made'''
-    consts = {Constants.unused, Constants.non_constant}
-    modified = False
-    for block, executed in ev.items():
-        if executed:
-            for instr in cfg._blockmap[block].body:
-                dest = instr.dest
-                opcode = instr.opcode
-                if opcode == 'phi':
-                    for i, (label_i, temporary_i) in enumerate(instr.uses()):
-
-                        if val[temporary_i] not in ({val[dest]} | consts) and val[dest] not in consts:
-                            modified |= update_dict(
-                                val, dest, Constants.non_constant)
-
-                        elif val[temporary_i] is Constants.non_constant and temporary_i[1].isdigit() and ev[label_i]:
-                            modified |= update_dict(
-                                val, dest, Constants.non_constant)
-
-                        elif val[temporary_i] not in consts:
-                            condition = True
-                            for j, (label_j, temporary_j) in enumerate(instr.uses()):
-                                if i != j:
-                                    if not (val[temporary_j] is Constants.unused or not ev[label_j] or val[temporary_j] == val[temporary_i]):
-                                        condition = False
-                            if condition:
-                                modified |= update_dict(
-                                    val, dest, val[temporary_i])
-                else:
-                    if opcode == "call" and dest:
-                        modified |= update_dict(
-                            val, dest, Constants.non_constant)
-                    elif opcode == "ret":
-                        modified |= update_dict(
-                            val, dest, Constants.non_constant)
-                    # if next(instr.uses(), None) is not None:
-                    elif opcode == 'param' or opcode == 'call':
-                        continue
-                    elif all(val[arg] not in {Constants.non_constant, Constants.unused} for arg in instr.uses()):
-                        modified |= update_dest(instr, dest, val)
-                    elif any(val[arg] == Constants.non_constant for arg in instr.uses()):
-                        modified |= update_dict(
-                            val, dest, Constants.non_constant)
-    return modified
-
-
-def remove_instrs(cfg: CFG, ev: dict, val: dict):
-    '''When ev and val are fully updated, removed redundant
-    instructions.
-    '''
-    new_blocks = []
-
-    for label, block in cfg.items():
-        new_body = []
+def _fold(opcode, args):
+    '''Value of an arithmetic instruction on constant (signed) operands,
+    computed on 64-bit words like the interpreter, or non_constant if it
+    must be left to run time (division by zero, shifts out of range)'''
+    if opcode in tac.unops:
+        return tac.untwoc(tac.unops[opcode](tac.twoc(args[0])))
+    u, v = args
+    if opcode in ('div', 'mod') and v == 0:
+        return Constants.non_constant
+    if opcode in ('shl', 'shr') and not 0 <= v < 64:
+        return Constants.non_constant
+    return tac.untwoc(tac.binops[opcode](tac.twoc(u), tac.twoc(v)))
+
+
+def _meet(a, b):
+    if a is Constants.unused: return b
+    if b is Constants.unused or a == b: return a
+    return Constants.non_constant
+
+
+class SparseSCCP:
+    '''Sparse conditional constant propagation (Wegman and Zadeck) over
+    the def-use edges of a CFG in SSA form.
+
+    Blocks become executable when one of their incoming edges does, which
+    is decided by the jumps of executable blocks. An instruction is only
+    evaluated again when the value of one of its operands goes down the
+    lattice (unused -> constant -> non_constant) or, for a phi, when one of
+    the edges into its block becomes executable.
+
+    Temporaries without a definition (the arguments), globals and the
+    results of calls are non_constant. The results are kept in the maps
+    `ev' (label -> executed) and `val' (temporary -> lattice value) of the
+    legacy implementation; `stats' counts the lattice transitions, the
+    instruction visits and the executable edges.'''
+
+    def __init__(self, cfg: CFG, du: DefUse = None):
+        self.cfg = cfg
+        self.du = du or DefUse(cfg)
+        self.ev = {label: False for label in cfg._blockmap}
+        self.val = dict()
+        for t in fetch_temporaries(cfg):
+            self.val[t] = Constants.unused if t in self.du.defs \
+                else Constants.non_constant
+        self.edges = set()
+        self.stats = {'transitions': {'unused->constant': 0,
+                                      'unused->non_constant': 0,
+                                      'constant->non_constant': 0},
+                      'visits': 0, 'executable_edges': 0,
+                      'executable_blocks': 0}
+
+    def value(self, arg):
+        if isinstance(arg, int): return arg
+        if is_local(arg): return self.val.get(arg, Constants.non_constant)
+        return Constants.non_constant
+
+    def lower(self, t, value):
+        '''Move `t' down to the meet of its value and `value', and return
+        whether it changed'''
+        old = self.val[t]
+        new = _meet(old, value)
+        if new == old: return False
+        self.val[t] = new
+        kind = lambda v: v.name if isinstance(v, Constants) else 'constant'
+        self.stats['transitions'][f'{kind(old)}->{kind(new)}'] += 1
+        return True
+
+    def evaluate(self, instr):
+        '''Lattice value computed by a non-phi instruction'''
+        opcode = instr.opcode
+        if opcode == 'const':
+            return tac.untwoc(tac.twoc(instr.arg1))
+        if opcode == 'copy':
+            return self.value(instr.arg1)
+        if opcode in tac.binops or opcode in tac.unops:
+            args = [self.value(arg) for arg in
+                    ((instr.arg1,) if opcode in tac.unops else (instr.arg1, instr.arg2))]
+            if any(a is Constants.non_constant for a in args):
+                return Constants.non_constant
+            if any(a is Constants.unused for a in args):
+                return Constants.unused
+            return _fold(opcode, args)
+        return Constants.non_constant
+
+    def visit_phi(self, instr, label):
+        value = Constants.unused
+        for label_prev, t in instr.arg1.items():
+            if (label_prev, label) in self.edges:
+                value = _meet(value, self.value(t))
+        return value
+
+    def visit_jumps(self, label):
+        '''Edges out of `label' that are executable given the current
+        values of the conditions'''
+        result = []
+        for jmp in self.cfg[label].jumps:
+            if jmp.opcode == 'jmp':
+                result.append(jmp.arg1)
+                break
+            if jmp.opcode == 'ret':
+                break
+            cond = self.value(jmp.arg1)
+            if cond is Constants.unused:
+                break
+            if cond is Constants.non_constant:
+                result.append(jmp.arg2)
+            elif tac.jumps[jmp.opcode](tac.twoc(cond)):
+                result.append(jmp.arg2)
+                break
+        return result
+
+    def run(self):
+        cfg, du = self.cfg, self.du
+        flow = [(cfg.proc_name, cfg.lab_entry)]
+        ssa = []
+
+        def visit(instr, label):
+            self.stats['visits'] += 1
+            if instr.opcode == 'phi':
+                value = self.visit_phi(instr, label)
+            elif instr.opcode in tac.jumps or instr.opcode in ('jmp', 'ret'):
+                flow.extend((label, label_next)
+                            for label_next in self.visit_jumps(label))
+                return
+            else:
+                value = self.evaluate(instr)
+            if is_local(instr.dest) and self.lower(instr.dest, value):
+                ssa.append(instr.dest)
+
+        while flow or ssa:
+            while flow:
+                edge = flow.pop()
+                if edge in self.edges: continue
+                self.edges.add(edge)
+                self.stats['executable_edges'] += 1
+                label = edge[1]
+                block = cfg[label]
+                if self.ev[label]:
+                    # only the phis depend on the new edge
+                    for instr in block.body:
+                        if instr.opcode != 'phi': break
+                        visit(instr, label)
+                    continue
+                self.ev[label] = True
+                self.stats['executable_blocks'] += 1
+                for instr in block.instrs():
+                    visit(instr, label)
+            while ssa and not flow:
+                for instr in du.uses(ssa.pop()):
+                    label = du.block_of.get(instr)
+                    if label is not None and self.ev[label]:
+                        visit(instr, label)
+        return self.ev, self.val
+
+
+def _fold_jumps(jumps, value):
+    '''Jumps of a block once the conditions known to be constant are
+    decided: a jump that is always taken becomes a `jmp' and ends the
+    block, one that is never taken is dropped'''
+    result = []
+    for jmp in jumps:
+        if jmp.opcode in tac.jumps:
+            cond = value(jmp.arg1)
+            if not isinstance(cond, Constants):
+                if tac.jumps[jmp.opcode](tac.twoc(cond)):
+                    result.append(Instr(None, 'jmp', (jmp.arg2,)))
+                    break
+                continue
+        result.append(jmp)
+        if jmp.opcode in ('jmp', 'ret'): break
+    return result
+
+
+def cleanup(cfg: CFG, ev: dict, val: dict, stats=None) -> CFG:
+    '''When ev and val are fully updated, remove the blocks that are
+    never executed, decide the constant jumps, delete the instructions
+    that define constants (or values that are never computed) and
+    replace the uses of these constants, phi arguments included. The
+    jumps are visited first, then every instruction once. Modifies the
+    cfg inplace.'''
+    consts = {t: c for t, c in val.items() if not isinstance(c, Constants)}
+    value = lambda arg: consts.get(arg, Constants.non_constant) \
+        if isinstance(arg, str) else arg
+    counts = {'blocks_removed': 0, 'jumps_folded': 0,
+              'instrs_removed': 0, 'uses_replaced': 0}
+    for label, executed in ev.items():
+        block = cfg[label]
+        if not executed:
+            cfg.remove_node(block)
+            counts['blocks_removed'] += 1
+            continue
+        jumps = _fold_jumps(block.jumps, value)
+        if jumps != block.jumps:
+            counts['jumps_folded'] += 1
+            targets = {j.arg1 if j.opcode == 'jmp' else j.arg2
+                       for j in jumps if j.opcode != 'ret'}
+            for label_next in list(cfg.successors(label)):
+                if label_next not in targets:
+                    cfg.remove_edge(label, label_next)
+            block.jumps = jumps
+
+    def substitute(arg):
+        if arg in consts:
+            counts['uses_replaced'] += 1
+            return consts[arg]
+        return arg
+    for block in cfg.nodes():
+        preds = set(cfg.predecessors(block.label))
+        if block.label == cfg.lab_entry: preds.add(cfg.proc_name)
+        body = []
         for instr in block.body:
-            if instr.opcode == 'param':
-                new_body.append(instr)
+            if instr.dest in consts or \
+               (instr.dest is not None and val.get(instr.dest) is Constants.unused):
+                counts['instrs_removed'] += 1
+                continue
+            if instr.opcode == 'phi':
+                instr.arg1 = {label_prev: substitute(t)
+                              for label_prev, t in instr.arg1.items()
+                              if label_prev in preds}
             else:
-                uses = [val[use[1]] == Constants.unused if isinstance(
-                    use, tuple) else val[use] == Constants.unused for use in instr.uses()]
-                if instr.dest:
-                    uses.append(val[instr.dest] == Constants.unused)
-                if not any(uses):
-                    new_body.append(instr)
-
-        new_blocks.append(Block(label, new_body, block.jumps))
-
-    return CFG(cfg.proc_name, cfg.lab_entry, new_blocks)
-
-
-def remove_blocks(cfg: CFG, ev: dict, val: dict):
-    '''When ev and val are fully updated, removed redundant
-    blocks. Modifies the cfg inplace.
-    '''
-    for label_block in ev:
-        if not ev[label_block]:
-            for block in cfg._blockmap:
-                new_jump_list = []
-                for jump in cfg._blockmap[block].jumps:
-                    if not (jump.arg1 == label_block or jump.arg2 == label_block):
-                        new_jump_list.append(jump)
-                cfg._blockmap[block].jumps = new_jump_list
-            cfg.remove_node(cfg._blockmap[label_block])
-
-
-def replace_temporaries(cfg: CFG, ev: dict, val: dict):
-    '''Whenever we have Val(u) = c ∈ {T,⊥}, we replace u 
-    with c and delete the instruction that sets u 
-    '''
-    not_consts = {Constants.unused, Constants.non_constant}
-
-    for u, c in val.items():
-        if c not in not_consts:
-            for label, block in cfg._blockmap.items():
-                instr_list = []
-                for instr in block.body:
-                    # Remove the instruction
-                    if instr.dest and instr.dest == u:
-                        continue
-                    # Replace u with c
-                    if u in instr.uses():
-                        instr.replace_use(u, c)
-                    instr_list.append(instr)
-                jmp_list = []
-                for jmp in block.jumps:
-                    if u in jmp.uses():
-                        jmp.replace_use(u, c)
-                    jmp_list.append(jmp)
-                cfg._blockmap[label] = Block(label, instr_list, jmp_list)
+                rewrite_use_temps_nonphi(instr, substitute)
+            body.append(instr)
+        block.body = body
+        for jmp in block.jumps:
+            rewrite_use_temps_nonphi(jmp, substitute)
+    if stats is not None:
+        stats.update(counts)
     return cfg
 
 
-def optimize_sccp(cfg: CFG) -> CFG:
-    '''Perform sccp for the given cfg'''
+def optimize_sccp(cfg: CFG, stats=None, du: DefUse = None) -> CFG:
+    '''Perform sccp for the given cfg, whose DefUse index can be given in
+    `du'. If `stats' is a dict, the statistics of the SparseSCCP engine
+    and of the cleanup are stored in it.'''
 
-    ev, val = initialize_conditions(cfg)
-    modified = True
-    while modified:
-        modified = False
-        modified |= update_ev(cfg, ev, val)
-        modified |= update_val(cfg, ev, val)
-    remove_blocks(cfg, ev, val)
-    cfg = remove_instrs(cfg, ev, val)
-    cfg = replace_temporaries(cfg, ev, val)
-    return cfg
+    engine = SparseSCCP(cfg, du)
+    ev, val = engine.run()
+    if stats is not None:
+        stats.update(engine.stats)
+    return cleanup(cfg, ev, val, stats)
 
 
 def exe_tac(tac_list: List):
-    """Execute a TAC program"""
+    """Execute a TAC program with the decoded engine of tacvm, which
+    supports the immediate operands left by the propagation"""
     gvars, procs = dict(), dict()
     for decl in tac_list:
         if isinstance(decl, Gvar):
             gvars[decl.name] = decl
         elif isinstance(decl, Proc):
             procs[decl.name] = decl
-    execute(gvars, procs, '@main', [])
+    tacvm.execute(gvars, procs, '@main', [])
 
 
 if __name__ == "__main__":
@@ -289,6 +298,8 @@ if __name__ == "__main__":
     ap.add_argument('fname', metavar='FILE', type=str, nargs=1,
                     help='The BX(JSON) file to process')
     ap.add_argument('-o', '--output', dest='output', type=str)
+    ap.add_argument('-v', dest='verbosity', default=0, action='count',
+                    help='print the statistics of the propagation')
     opts = ap.parse_args(sys.argv[1:])
     fname = opts.fname[0]
 
@@ -302,7 +313,13 @@ if __name__ == "__main__":
     new_tac_list = []
     for count, decl in enumerate(tac_list):
         if isinstance(decl, Proc):
-            optimize_sccp(decl)
+            cfg = infer(decl)
+            crude_ssagen(decl, cfg)
+            stats = dict()
+            cfg = optimize_sccp(cfg, stats)
+            linearize(decl, cfg)
+            if opts.verbosity:
+                print(f'// {decl.name}: {stats}', file=sys.stderr)
         new_tac_list.append(decl)
 
     # Write the output file if requested
@@ -314,8 +331,7 @@ if __name__ == "__main__":
         try:
             exe_tac(new_tac_list)
         except Exception as e:
-            print(
-                f'Problem executing: {e} (most likely due to execute not handling immediates)')
+            print(f'Problem executing: {e}')
             sys.exit(1)
 
         # cfg.write_dot(fname + '.dot')
@@ -1,24 +1,35 @@
 import argparse
-import copy
 import sys
+import time
 from enum import Enum, auto
-from typing import List, Union
+from typing import List
 
 from cfg import *
 from cfg import CFG, infer
+from defuse import DefUse, is_local
 from ssagen import *
 from ssagen import crude_ssagen
 from tac import *
 from tac import Proc
 
 
-def minimize(cfg : CFG) -> CFG:
-    """Performs minimization"""
+def minimize(cfg : CFG, scc=False, stats=None) -> CFG:
+    """Performs minimization. With `scc', all the redundant phis are found
+    at once by `remove_redundant_phis', which works in place; otherwise
+    NCE and renaming are alternated. If `stats' is a dict, the number of
+    phis removed and the time taken are stored in it."""
+    if scc:
+        return remove_redundant_phis(cfg, stats)
+    start = time.perf_counter()
+    phis_before = _count_phis(cfg)
     modif1, modif2 = True, True
     while modif1 or modif2: 
         # We run the minimization until there are no more modification
         modif1, cfg = NCE(cfg)
         modif2, cfg = rename(cfg)  
+    if stats is not None:
+        stats['phis_removed'] = phis_before - _count_phis(cfg)
+        stats['time'] = time.perf_counter() - start
     return cfg
 
 def show_cfg(cfg : CFG):
@@ -53,49 +64,19 @@ def NCE(cfg: CFG) -> CFG:
 def rename(cfg:CFG) -> CFG:
     """Performs renaming"""
     modif = False
-    cfg_copy = copy.deepcopy(cfg)
-    for index, instr in enumerate(cfg_copy.instrs()):
-        if (instr.opcode == "phi") and is_rn(instr):
+    du = DefUse(cfg)
+    for instr in list(cfg.instrs()):
+        if instr in du and instr.opcode == "phi" and is_rn(instr):
             # We found an instruction that has to be renamed
-            modif = True
             to_replace = instr.dest # Temp that we should replace
             to_use = set(list(instr.arg1.values())) 
             if to_replace in to_use: to_use.remove(to_replace)
-            try:
-                to_use = to_use.pop() # Temp we should use instead
-            except:
-                print(to_replace , to_use)
-                raise KeyError
-            
-            new_blocks = []
-            for block in cfg._blockmap.values():
-                # We iterate over the cfg to edit the instruction that have to be
-                inst_list = []
-                for instru in block.body:
-                    if (instru.opcode == "phi" and (to_replace == instru.dest or to_replace in instru.arg1.values())):
-                        new_args1 = {}
-                        for key, value in instru.arg1.items():
-                            new_args1[key] = to_use if value == to_replace else value
-                        new_args2 = {}
-                        if instru.arg2:
-                            for key, value in instru.arg2.items():
-                                new_args2[key] = to_use if value == to_replace else value
-                        inst_list.append(Instr(to_use if to_replace == instru.dest else instru.dest, instru.opcode,
-                                        [new_args1, new_args2] if new_args2 else [new_args1]))
-                    elif (instru.opcode != "phi" and (to_replace == instru.dest or to_replace in {instru.arg1, instru.arg2})):
-                        new_args1 = to_use if instru.arg1 == to_replace else instru.arg1
-                        if instru.arg2:
-                            new_args2 = to_use if instru.arg2 == to_replace else instru.arg2
-                        else:
-                            new_args2 = False
-                        inst_list.append(Instr(to_use if to_replace == instru.dest else instru.dest, instru.opcode,
-                                        [new_args1, new_args2] if new_args2 else [new_args1]))
-                    else:
-                        inst_list.append(instru)
-                new_block = Block(block.label, inst_list, block.jumps)
-                new_blocks.append(new_block)
-
-            cfg = CFG(cfg.proc_name, cfg.lab_entry, new_blocks)
+            if not is_local(to_replace) or not to_use: continue
+            modif = True
+            to_use = to_use.pop() # Temp we should use instead
+            # The uses are found through the def-use index
+            du.erase_instr(instr)
+            du.replace_all_uses(to_replace, to_use)
     return modif, cfg
 
 
@@ -120,6 +101,125 @@ def is_rn(ins : tac.Instr) -> bool:
             val =True
     return (len(s)==2 and val) or len(s)==1
 
+# ------------------------------------------------------------------------------
+# SCC-based redundant phi elimination
+
+def _count_phis(cfg):
+    return sum(1 for instr in cfg.instrs() if instr.opcode == 'phi')
+
+
+class UnionFind:
+    """Maps the dest of every removed phi to the value that replaces it"""
+
+    def __init__(self):
+        self.parent = dict()
+
+    def find(self, t):
+        root = t
+        while root in self.parent:
+            root = self.parent[root]
+        while t != root:
+            self.parent[t], t = root, self.parent[t]
+        return root
+
+    def union(self, t, value):
+        if self.find(value) != t:
+            self.parent[t] = value
+
+
+def _phi_sccs(phis, operands):
+    """Strongly connected components of the graph from each phi in `phis'
+    (a dict dest -> phi) to the phis among its operands, by Tarjan's
+    algorithm. A component comes after those of its operands."""
+    index, low, on_stack = dict(), dict(), set()
+    stack, result = [], []
+    for root in phis:
+        if root in index: continue
+        index[root] = low[root] = len(index)
+        stack.append(root); on_stack.add(root)
+        work = [(root, iter(operands(phis[root])))]
+        while work:
+            t, ops = work[-1]
+            for u in ops:
+                if u not in phis: continue
+                if u not in index:
+                    index[u] = low[u] = len(index)
+                    stack.append(u); on_stack.add(u)
+                    work.append((u, iter(operands(phis[u]))))
+                    break
+                if u in on_stack:
+                    low[t] = min(low[t], index[u])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[t])
+                if low[t] == index[t]:
+                    scc = []
+                    while True:
+                        u = stack.pop(); on_stack.discard(u)
+                        scc.append(u)
+                        if u == t: break
+                    result.append(scc)
+    return result
+
+
+def _remove_sccs(phis, uf):
+    """Replace each component of `phis' that only sees one value from
+    outside by that value, then look again inside the components that
+    see more (Braun et al., "Simple and Efficient Construction of Static
+    Single Assignment Form", algorithm 5)"""
+    operands = lambda phi: [uf.find(t) for t in phi.arg1.values()]
+    for scc in _phi_sccs(phis, operands):
+        members = set(scc)
+        inner, outer = dict(), set()
+        for t in scc:
+            ops = set(operands(phis[t])) - members
+            if ops: outer |= ops
+            else: inner[t] = phis[t]
+        if len(outer) == 1:
+            value = outer.pop()
+            for t in scc: uf.union(t, value)
+        elif len(outer) > 1 and inner:
+            _remove_sccs(inner, uf)
+
+
+def remove_redundant_phis(cfg : CFG, stats=None) -> CFG:
+    """Remove the phis that always give the same value, with all the
+    phis that only depend on each other, in one pass. The replacements
+    are recorded in a union-find, then the phis are deleted and the uses
+    rewritten in a single sweep over the instructions."""
+    start = time.perf_counter()
+    uf = UnionFind()
+    phis, dropped = dict(), set()
+    for instr in cfg.instrs():
+        if instr.opcode != 'phi': continue
+        if instr.dest.startswith('@'):
+            # globals are not renamed: such a phi can only copy the global
+            # to itself
+            if all(t == instr.dest for t in instr.arg1.values()):
+                dropped.add(instr)
+            continue
+        phis[instr.dest] = instr
+    _remove_sccs(phis, uf)
+    dropped.update(phi for t, phi in phis.items() if t in uf.parent)
+    for bl in cfg.nodes():
+        body = []
+        for instr in bl.body:
+            if instr in dropped: continue
+            if instr.opcode == 'phi':
+                instr.arg1 = {l: uf.find(t) for l, t in instr.arg1.items()}
+            else:
+                rewrite_use_temps_nonphi(instr, uf.find)
+            body.append(instr)
+        bl.body = body
+        for instr in bl.jumps:
+            rewrite_use_temps_nonphi(instr, uf.find)
+    if stats is not None:
+        stats['phis_removed'] = len(dropped)
+        stats['time'] = time.perf_counter() - start
+    return cfg
+
 
 if __name__=='__main__':
     import os
@@ -128,6 +228,8 @@ if __name__=='__main__':
     ap.add_argument('file', metavar='FILE', type=str, nargs=1, help='A TAC file')
     ap.add_argument('-v', dest='verbosity', default=0, action='count',
                     help='increase verbosity')
+    ap.add_argument('--scc', dest='scc', action='store_true', default=False,
+                    help='Remove the redundant phis in one pass (remove_redundant_phis)')
     args = ap.parse_args()
     gvars, procs = dict(), dict()
     for tlv in tac.load_tac(args.file[0]):
@@ -137,7 +239,10 @@ if __name__=='__main__':
             for ins in cfg.instrs():
                 print(ins)
             print('\n\n')
-            cfg = minimize(cfg)
+            stats = dict()
+            cfg = minimize(cfg, scc=args.scc, stats=stats)
+            print(f'// {tlv.name}: removed {stats["phis_removed"]} phis '
+                  f'in {stats["time"]:.6f}s')
             # print(tlv)
             for ins in cfg.instrs():
                 print(ins)
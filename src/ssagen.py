@@ -2,58 +2,61 @@
 
 import tac
 import cfg as cfglib
-import re, random, os
+from symtab import split_version
+from dom_tree import DomTree, dominance_frontiers, iterated_frontier
+import random, os
 
 # ------------------------------------------------------------------------------
 # liveness
 
-_arg1_use = re.compile(r'add|sub|mul|div|mod|neg|and|or|xor|not|shl|shr|copy|ret|jz|jnz|jl|jle|jnl|jnle')
-_arg2_use = re.compile(r'add|sub|mul|div|mod|and|or|xor|shl|shr|param')
-_dest_def = re.compile(r'add|sub|mul|div|mod|neg|and|or|xor|not|shl|shr|const|copy|phi|call')
+_props = tac.opcode_props
+_ARG1_USE = tac.OpProp.ARG1_IS_USE
+_ARG2_USE = tac.OpProp.ARG2_IS_USE
+_DEST_DEF = tac.OpProp.DEFINES_DEST
 
 def use_set(instr):
     s = set()
-    if _arg1_use.fullmatch(instr.opcode) and instr.arg1: s.add(instr.arg1)
-    if _arg2_use.fullmatch(instr.opcode) and instr.arg2: s.add(instr.arg2)
+    props = _props.get(instr.opcode, 0)
+    if props & _ARG1_USE and instr.arg1: s.add(instr.arg1)
+    if props & _ARG2_USE and instr.arg2: s.add(instr.arg2)
     if instr.opcode == 'phi': s.update(instr.arg1.values())
     return s
 
 def rewrite_use_temps_nonphi(instr, fn):
-    if _arg1_use.fullmatch(instr.opcode) and instr.arg1:
+    props = _props.get(instr.opcode, 0)
+    if props & _ARG1_USE and instr.arg1:
         instr.arg1 = fn(instr.arg1)
-    if _arg2_use.fullmatch(instr.opcode) and instr.arg2:
+    if props & _ARG2_USE and instr.arg2:
         instr.arg2 = fn(instr.arg2)
 
 def def_set(instr):
     s = set()
-    if _dest_def.fullmatch(instr.opcode) and instr.dest: s.add(instr.dest)
+    if _props.get(instr.opcode, 0) & _DEST_DEF and instr.dest: s.add(instr.dest)
     return s
 
 def rewrite_temps(instr, fn):
-    if _arg1_use.fullmatch(instr.opcode) and instr.arg1:
+    props = _props.get(instr.opcode, 0)
+    if props & _ARG1_USE and instr.arg1:
         instr.arg1 = fn(instr.arg1)
-    if _arg2_use.fullmatch(instr.opcode) and instr.arg2:
+    if props & _ARG2_USE and instr.arg2:
         instr.arg2 = fn(instr.arg2)
     if instr.opcode == 'phi':
         for l, t in instr.arg1.items():
             instr.arg1[l] = fn(t)
-    if _dest_def.fullmatch(instr.opcode) and instr.dest:
+    if props & _DEST_DEF and instr.dest:
         instr.dest = fn(instr.dest)
 
 # ------------------------------------------------------------------------------
 # crude SSA gen
 
 def tmp_root(tmp):
-    try: return tmp[:tmp.rindex('.')]
-    except ValueError: return tmp
+    return split_version(tmp)[0]
 
 def tmp_version(tmp):
-    try: return tmp[tmp.rindex('.')+1:]
-    except ValueError: return ''
+    return split_version(tmp)[1]
 
-def crude_ssagen(tlv, cfg):
-    livein, liveout = dict(), dict()
-    cfglib.recompute_liveness(cfg, livein, liveout)
+def crude_ssagen(tlv, cfg, live=None):
+    livein = (live or cfglib.Liveness(cfg)).livein
     for bl in cfg.nodes():
         prev_labs = list(cfg.predecessors(bl.label))
         ts = livein[bl.first_instr()]
@@ -78,6 +81,76 @@ def crude_ssagen(tlv, cfg):
             for lab_prev, root in instr.arg1.items():
                 instr.arg1[lab_prev] = ver_maps[lab_prev].get(root, root)
 
+# ------------------------------------------------------------------------------
+# pruned SSA gen
+
+def pruned_ssagen(tlv, cfg, live=None, tree=None):
+    """Alternative to crude_ssagen with the same output conventions.
+
+    A local temporary gets a phi only in the blocks of the iterated
+    dominance frontier of its definitions where it is live on entry
+    (pruned SSA, after Cytron et al.). The versions are then assigned
+    along the dominator tree, each use taking the version of the nearest
+    dominating definition. Temporaries used without a definition on some
+    path, such as the arguments, keep their unversioned names there.
+
+    `live' and `tree' can give the Liveness and DomTree of the cfg if they
+    are already known."""
+    live = live or cfglib.Liveness(cfg)
+    tree = tree or DomTree(cfg)
+    df = dominance_frontiers(cfg, tree)
+    temp_ids = live.symtab.temp_ids
+    defsites = dict()
+    for bl in cfg.nodes():
+        if bl.label not in tree: continue
+        for instr in bl.instrs():
+            if instr.dest and instr.dest.startswith('%'):
+                defsites.setdefault(instr.dest, set()).add(bl.label)
+    phis = {lab: [] for lab in cfg.blocks()}
+    for t, labs in defsites.items():
+        bit = 1 << temp_ids[t]
+        # the entry block implicitly defines the unversioned temporary
+        for lab in iterated_frontier(df, labs | {cfg.lab_entry}):
+            if not live.live_in[lab] & bit: continue
+            prev_labs = list(cfg.predecessors(lab))
+            if lab == cfg.lab_entry: prev_labs.append(cfg.proc_name)
+            phis[lab].append(tac.Instr(t, 'phi', ({l: t for l in prev_labs}, None)))
+    for lab, lab_phis in phis.items():
+        cfg[lab].body[:0] = lab_phis
+
+    versions = cfglib.counter(transfn=lambda x: f'.{x}')
+    stacks = dict()
+    def current(t):
+        stack = stacks.get(t)
+        return stack[-1] if stack else t
+    def rename(lab):
+        pushed = []
+        for instr in cfg[lab].instrs():
+            if instr.opcode != 'phi':
+                rewrite_use_temps_nonphi(instr, current)
+            if instr.dest and instr.dest.startswith('%'):
+                root = instr.dest
+                instr.dest = root + next(versions)
+                stacks.setdefault(root, []).append(instr.dest)
+                pushed.append(root)
+        for lab_next in cfg.successors(lab):
+            for phi in phis[lab_next]:
+                phi.arg1[lab] = current(phi.arg1[lab])
+        return pushed
+    # the unreachable blocks are renamed on their own, as if they were
+    # dominated by nothing
+    starts = [lab for lab in cfg.blocks() if lab not in tree]
+    starts.append(tree.entry)
+    for start in starts:
+        work = [(start, None)]
+        while work:
+            lab, pushed = work.pop()
+            if pushed is not None:
+                for root in pushed: stacks[root].pop()
+                continue
+            work.append((lab, rename(lab)))
+            work.extend((kid, None) for kid in reversed(tree.children.get(lab, ())))
+
 # ------------------------------------------------------------------------------
 
 def make_dotfiles(cfg, procname, fname, verbosity):
@@ -98,12 +171,14 @@ if __name__ == '__main__':
     ap.add_argument('file', metavar='FILE', type=str, nargs=1, help='A TAC file')
     ap.add_argument('-v', dest='verbosity', default=0, action='count',
                     help='increase verbosity')
+    ap.add_argument('--pruned', dest='pruned', action='store_true', default=False,
+                    help='Place phis at the dominance frontiers (pruned_ssagen)')
     args = ap.parse_args()
     gvars, procs = dict(), dict()
     for tlv in tac.load_tac(args.file[0]):
         if isinstance(tlv, tac.Proc):
             cfg = cfglib.infer(tlv)
-            crude_ssagen(tlv, cfg)
+            (pruned_ssagen if args.pruned else crude_ssagen)(tlv, cfg)
             make_dotfiles(cfg, tlv.name[1:], args.file[0], args.verbosity)
             if args.verbosity >= 2:
                 cfglib.linearize(tlv, cfg)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Per-proc symbol tables
+
+A SymbolTable interns the temporaries and labels of a proc into dense
+integer IDs, so that analyses can index lists and bitsets by ID instead
+of hashing strings. The instructions keep their strings, which remain
+the form that is printed and dumped to JSON.
+
+The root and version of every temporary (`%x' and `3' for `%x.3') are
+computed once when it is interned.
+"""
+
+from functools import lru_cache
+
+import tac
+
+# ------------------------------------------------------------------------------
+
+
+@lru_cache(maxsize=1 << 16)
+def split_version(tmp):
+    """Return the root and version of a temporary, e.g. ('%x', '3') for
+    `%x.3', or (tmp, '') if it has no version. The cache is bounded, as
+    it is shared by all the procs of the process."""
+    i = tmp.rfind('.')
+    if i < 0: return tmp, ''
+    return tmp[:i], tmp[i + 1:]
+
+
+def is_temp(thing):
+    """Same test as tac.Instr._istemp: locals and globals, not labels"""
+    return isinstance(thing, str) and \
+        (thing.startswith('%') or thing.startswith('@')) and \
+        not thing.startswith('%.L')
+
+
+class SymbolTable:
+    """Dense integer IDs for the temporaries, roots and labels of a proc.
+    Temporaries and labels have separate ID spaces, both starting at 0
+    in order of first appearance; the arguments of the proc come first."""
+
+    def __init__(self, proc=None):
+        self.temps = []         # temp ID -> name
+        self.temp_ids = dict()  # name -> temp ID
+        self.roots = []         # root ID -> name
+        self.root_ids = dict()  # name -> root ID
+        self.root_of = []       # temp ID -> root ID
+        self.version_of = []    # temp ID -> version ('' if none)
+        self.labels = []        # label ID -> name
+        self.label_ids = dict() # name -> label ID
+        if proc is not None:
+            self.add_proc(proc)
+
+    # --------------------------------------------------------------------------
+    # interning
+
+    def temp(self, name):
+        """ID of the temporary `name', interning it if needed"""
+        tid = self.temp_ids.get(name)
+        if tid is None:
+            tid = self.temp_ids[name] = len(self.temps)
+            self.temps.append(name)
+            root, version = split_version(name)
+            rid = self.root_ids.get(root)
+            if rid is None:
+                rid = self.root_ids[root] = len(self.roots)
+                self.roots.append(root)
+            self.root_of.append(rid)
+            self.version_of.append(version)
+        return tid
+
+    def label(self, name):
+        """ID of the label `name', interning it if needed"""
+        lid = self.label_ids.get(name)
+        if lid is None:
+            lid = self.label_ids[name] = len(self.labels)
+            self.labels.append(name)
+        return lid
+
+    def add_instr(self, instr):
+        """Intern the temporaries and labels of `instr'"""
+        if instr.opcode == 'label':
+            self.label(instr.arg1)
+            return
+        for t in instr.defs(): self.temp(t)
+        if instr.opcode == 'phi':
+            # cfg.normalize_labels turns the arguments into (label, temp) pairs
+            args = instr.arg1.items() if isinstance(instr.arg1, dict) else instr.arg1
+            for lab, t in args:
+                self.label(lab)
+                if is_temp(t): self.temp(t)
+            return
+        for t in instr.uses(): self.temp(t)
+
+    def add_proc(self, proc):
+        for t in proc.t_args: self.temp(t)
+        for instr in proc.body: self.add_instr(instr)
+
+    @classmethod
+    def for_cfg(cls, cfg, t_args=()):
+        """Symbol table of a CFG: the labels are numbered in block order"""
+        st = cls()
+        for t in t_args: st.temp(t)
+        for lab in cfg.blocks(): st.label(lab)
+        for instr in cfg.instrs(): st.add_instr(instr)
+        return st
+
+    # --------------------------------------------------------------------------
+    # queries
+
+    def is_global(self, tid):
+        return self.temps[tid].startswith('@')
+
+    def root(self, tid):
+        """Name of the root of the temporary with ID `tid'"""
+        return self.roots[self.root_of[tid]]
+
+    def version(self, tid):
+        return self.version_of[tid]
+
+    def versions(self):
+        """Return a list mapping each root ID to the IDs of its versions"""
+        result = [[] for _ in self.roots]
+        for tid, rid in enumerate(self.root_of):
+            result[rid].append(tid)
+        return result
+
+    def bits(self, names):
+        """Bitset (an int) of the temporaries in `names'"""
+        temp = self.temp
+        b = 0
+        for name in names:
+            b |= 1 << temp(name)
+        return b
+
+    def names(self, bits):
+        """Names of the temporaries in the bitset `bits', in ID order"""
+        temps = self.temps
+        result = []
+        while bits:
+            low = bits & -bits
+            result.append(temps[low.bit_length() - 1])
+            bits ^= low
+        return result
+
+    def __len__(self):
+        return len(self.temps)
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Print the symbol tables of TAC procs')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='*',
+                    help='A TAC file (.tac or .tac.json)')
+    args = ap.parse_args()
+    for srcfile in args.files:
+        for tlv in tac.load_tac(srcfile):
+            if not isinstance(tlv, tac.Proc): continue
+            st = SymbolTable(tlv)
+            print(f'proc {tlv.name}: {len(st.temps)} temporaries, '
+                  f'{len(st.roots)} roots, {len(st.labels)} labels')
+            for tid, name in enumerate(st.temps):
+                print(f'  t{tid} = {name}  (root r{st.root_of[tid]}'
+                      f'{", version " + st.version_of[tid] if st.version_of[tid] else ""})')
+            for lid, name in enumerate(st.labels):
+                print(f'  l{lid} = {name}')
@@ -26,18 +26,58 @@ opcode_kinds = {
 }
 opcodes = frozenset(opcode_kinds.keys())
 
+
+class OpProp:
+    """Bits of the properties of an opcode in `opcode_props'"""
+    JUMP = 1 << 0           # jmp and the conditional jumps
+    COND_JUMP = 1 << 1      # jz, jnz, jl, jle, jnl, jnle
+    TERMINATOR = 1 << 2     # ends a basic block: jumps and ret
+    NO_FALLTHROUGH = 1 << 3 # never continues with the next instruction: jmp, ret
+    DEFINES_DEST = 1 << 4   # writes its (possibly optional) dest
+    ARG1_IS_USE = 1 << 5    # reads arg1 as a value
+    ARG2_IS_USE = 1 << 6    # reads arg2 as a value
+    BINOP = 1 << 7          # arithmetic on arg1 and arg2
+    UNOP = 1 << 8           # arithmetic on arg1 (not copy)
+    COMMUTATIVE = 1 << 9    # arg1 and arg2 can be swapped
+    SIDE_EFFECT = 1 << 10   # must be kept even if its dest is never read
+
+
+def _opcode_props(op, kinds):
+    props = 0
+    if op == 'jmp' or kinds == 'NVL': props |= OpProp.JUMP
+    if kinds == 'NVL': props |= OpProp.COND_JUMP
+    if op in ('jmp', 'ret'): props |= OpProp.NO_FALLTHROUGH
+    if props & OpProp.JUMP or op == 'ret': props |= OpProp.TERMINATOR
+    if kinds[0] in 'VO': props |= OpProp.DEFINES_DEST
+    if kinds[1] in 'VO': props |= OpProp.ARG1_IS_USE
+    if kinds[2] == 'V': props |= OpProp.ARG2_IS_USE
+    if kinds == 'VVV': props |= OpProp.BINOP
+    if kinds == 'VVN' and op != 'copy': props |= OpProp.UNOP
+    if op in ('add', 'mul', 'and', 'or', 'xor'): props |= OpProp.COMMUTATIVE
+    if op in ('label', 'param', 'call') or props & OpProp.TERMINATOR:
+        props |= OpProp.SIDE_EFFECT
+    return props
+
+# Maps every opcode to the OpProp bits that apply to it, e.g.
+# opcode_props['jz'] & OpProp.COND_JUMP. The bits are plain ints so that
+# testing them is as cheap as possible.
+opcode_props = {op: _opcode_props(op, kinds)
+                for op, kinds in opcode_kinds.items()}
+
 class Instr:
-    __slots__ = ('dest', 'opcode', 'arg1', 'arg2')
+    __slots__ = ('dest', 'opcode', 'arg1', 'arg2', 'nargs')
     def __init__(self, dest, opcode, args):
         """Create a new TAC instruction with given `opcode' (must be non-None).
         The other three arguments, `dest', 'arg1', and 'arg2' depend on what
-        the opcode is.
+        the opcode is. The length of `args' is kept in `nargs' so that
+        `js_obj' gives back the same number of arguments.
 
         Raises ValueError if attempting to create an invalid Instr."""
         self.dest = dest
         self.opcode = opcode
         self.arg1 = None if len(args) < 1 else args[0]
         self.arg2 = None if len(args) < 2 else args[1]
+        self.nargs = len(args)
         # self._check() # No longer used as instructions are now more flexible
 
     def __hash__(self):
@@ -176,8 +216,11 @@ class Instr:
     @property
     def js_obj(self):
         """A basic Python object ready to JSONify with json.dump()"""
+        args = (self.arg1, self.arg2)
+        if all(a is None for a in args[self.nargs:]):
+            args = args[:self.nargs]
         return {'opcode': self.opcode,
-                'args': (self.arg1, self.arg2),
+                'args': args,
                 'result': self.dest}
 
 class Proc:
@@ -186,6 +229,29 @@ class Proc:
         self.body = body or []
         self.t_args = tuple(t_args)
 
+    @property
+    def body(self):
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self._tables = None
+
+    def invalidate_tables(self):
+        """Drop the ProcTables, after the body or its instructions were
+        edited in place"""
+        self._tables = None
+
+    def tables(self):
+        """The ProcTables of the body, shared by all the calls to this
+        proc. They are rebuilt when the body is replaced or changes
+        length, and after `invalidate_tables', which the code that edits
+        the body in place (e.g. cfg.infer) must call."""
+        if self._tables is None or not self._tables.valid_for(self._body):
+            self._tables = ProcTables(self)
+        return self._tables
+
     def __str__(self):
         result = StringIO()
         result.write(f'proc {self.name}({", ".join(self.t_args)}):\n')
@@ -460,6 +526,75 @@ class TempMap(dict):
         else:
             super().__setitem__(tmp, val)
 
+class ProcTables:
+    """Decoded form of a proc body used by the interpreter:
+    - labels: maps each label to the index of the first instruction after
+      its group of labels
+    - targets: the index to jump to for every jump instruction (None for
+      other instructions and for unknown destinations)
+    - edges: the phi copies of every edge (see `phi_edges')"""
+
+    def __init__(self, proc):
+        body = proc.body
+        self._key = (id(body), len(body))
+        self.labels = dict()
+        for i, instr in enumerate(body):
+            if instr.opcode != 'label': continue
+            if instr.arg1 in self.labels:
+                raise RuntimeError(f'Reused label {instr.arg1}')
+            ni = i + 1 # next instruction index
+            while ni < len(body):
+                if body[ni].opcode != 'label': break
+                ni += 1
+            self.labels[instr.arg1] = ni
+        self.targets = [None] * len(body)
+        for i, instr in enumerate(body):
+            if instr.opcode == 'jmp':
+                self.targets[i] = self.labels.get(instr.arg1)
+            elif instr.opcode in jumps:
+                self.targets[i] = self.labels.get(instr.arg2)
+        self.edges = phi_edges(proc, self.labels)
+
+    def valid_for(self, body):
+        return self._key == (id(body), len(body))
+
+def phi_edges(proc, labels):
+    """Map every label that starts a group of phis to a pair (count,
+    copies): `count' is the number of phis in the group, and `copies'
+    maps the label of each predecessor to the list of (dest, src) pairs
+    to assign in parallel when coming from that predecessor.
+    `labels' maps labels to the index of the instruction they precede."""
+    edges = dict()
+    for lab, pc in labels.items():
+        phis = []
+        while pc + len(phis) < len(proc.body) and \
+                proc.body[pc + len(phis)].opcode == 'phi':
+            phis.append(proc.body[pc + len(phis)])
+        if not phis: continue
+        copies = {lab_from: [] for lab_from in phis[0].arg1}
+        for phi in phis:
+            for lab_from in list(copies):
+                if lab_from in phi.arg1:
+                    copies[lab_from].append((phi.dest, phi.arg1[lab_from]))
+                else:
+                    del copies[lab_from]
+        edges[lab] = (len(phis), copies)
+    return edges
+
+def take_edge(values, edges, lab_from, lab_to):
+    """Assign the phis at `lab_to' for an edge from `lab_from', and return
+    the number of phis to skip"""
+    if lab_to not in edges: return 0
+    count, copies = edges[lab_to]
+    if lab_from not in copies:
+        raise RuntimeError(f'cannot resolve phi: '
+                           f'came from {lab_from}, '
+                           f'can only handle [{",".join(copies.keys())}]')
+    vals = [values[src] for _, src in copies[lab_from]]
+    for (dest, _), val in zip(copies[lab_from], vals):
+        values[dest] = val
+    return count
+
 def execute(gvars, procs, proc_name, args, **kwargs):
     show_proc = kwargs.get('show_proc', False)
     show_instr = kwargs.get('show_instr', False)
@@ -473,21 +608,13 @@ def execute(gvars, procs, proc_name, args, **kwargs):
     for i in range(len(proc.t_args)):
         values[proc.t_args[i]] = args[i]
 
-    oldvalues = values.copy()
-
     proc_desc = f'{proc_name}({",".join(k + "=" + str(v) for k, v in values.items())})'
     if show_proc: print(f'// {indent}entering {proc_desc}')
 
-    labels = dict()
-    for i, instr in enumerate(proc.body):
-        if instr.opcode != 'label': continue
-        if instr.arg1 in labels:
-            raise RuntimeError(f'Reused label {instr.arg1}')
-        ni = i + 1 # next instruction index
-        while ni < len(proc.body):
-            if proc.body[ni].opcode != 'label': break
-            ni += 1
-        labels[instr.arg1] = ni
+    tables = proc.tables()
+    labels, targets = tables.labels, tables.targets
+    # phis are resolved by parallel copies on the edges that reach them
+    edges = tables.edges
 
     lab_prev, lab_cur = None, proc_name
     pc = 0
@@ -502,31 +629,24 @@ def execute(gvars, procs, proc_name, args, **kwargs):
         elif instr.opcode == 'label':
             lab_prev, lab_cur = lab_cur, instr.arg1
         elif instr.opcode == 'phi':
-            for lab, tmp in instr.arg1.items():
-                #print(instr)
-                if lab == lab_prev:
-                    values[instr.dest] = oldvalues[tmp]
-                    break
-            else:
-                
-                raise RuntimeError(f'cannot resolve phi: '
-                                   f'came from {lab_prev}, '
-                                   f'can only handle [{",".join(instr.arg1.keys())}]')
+            # only reached by falling through into the block
+            if lab_cur not in edges or labels[lab_cur] != pc - 1:
+                raise RuntimeError(f'phi not at the start of {lab_cur}: {instr}')
+            pc += take_edge(values, edges, lab_prev, lab_cur) - 1
         elif instr.opcode == 'jmp':
-            if instr.arg1 not in labels:
+            tgt = targets[pc - 1]
+            if tgt is None:
                 raise RuntimeError(f'Unknown jump destination {instr.arg1}')
             lab_prev, lab_cur = lab_cur, instr.arg1
-            oldvalues = values.copy()
-            pc = labels[lab_cur]
+            pc = tgt + take_edge(values, edges, lab_prev, lab_cur)
         elif instr.opcode in jumps:
             k = values[instr.arg1]
-            if instr.arg2 not in labels:
-        
+            tgt = targets[pc - 1]
+            if tgt is None:
                 raise RuntimeError(f'Unknown jump destination {instr.arg2}')
             if jumps[instr.opcode](k):
                 lab_prev, lab_cur = lab_cur, instr.arg2
-                oldvalues = values.copy()
-                pc = labels[lab_cur]
+                pc = tgt + take_edge(values, edges, lab_prev, lab_cur)
         elif instr.opcode == 'const':
             if not isinstance(instr.arg1, int):
                 print(f'Missing or bad argument: {instr.arg1}')
@@ -606,7 +726,13 @@ def load_tac(tac_file):
             raise ValueError(f'TAC file must be a .tac or a .tac.json')
 
 if __name__ == '__main__':
-    from argparse import ArgumentParser
+    from argparse import ArgumentParser, ArgumentTypeError
+
+    def positive_int(text):
+        value = int(text)
+        if value < 1:
+            raise ArgumentTypeError(f'must be at least 1, not {value}')
+        return value
     ap = ArgumentParser(description='TAC parser and interpreter')
     ap.add_argument('files', metavar='FILE', type=str, nargs='*',
                     help='A TAC file (.tac or .tac.json)')
@@ -627,7 +753,27 @@ if __name__ == '__main__':
     ap.add_argument('--no-exec', dest='execute', action='store_false',
                     default=True,
                     help='Do not run the interpreter')
+    ap.add_argument('--engine', dest='engine', default='reference',
+                    choices=('reference', 'threaded', 'compiled'),
+                    help='Interpreter to run: the reference one, the '
+                         'pre-decoded closure-threaded one from tacvm.py, '
+                         'or compiled to Python by tac2py.py '
+                         '(--trace-instrs needs the reference engine)')
+    ap.add_argument('--memoize', dest='memoize', action='store_true',
+                    default=False,
+                    help='Cache the results of pure procs (threaded engine '
+                         'only); -v prints the cache statistics')
+    ap.add_argument('--memo-size', dest='memo_size', type=positive_int, default=4096,
+                    help='Number of results kept by --memoize (default 4096)')
+    ap.add_argument('--profile', dest='profile', action='store_true',
+                    default=False,
+                    help='Write the call, block, edge and opcode counts of '
+                         'the run to FILE.profile.json (threaded engine only)')
     args = ap.parse_args()
+    if args.memoize and args.engine != 'threaded':
+        ap.error('--memoize needs --engine threaded')
+    if args.profile and args.engine != 'threaded':
+        ap.error('--profile needs --engine threaded')
     if args.trace_all:
         args.trace_procs = True
         args.trace_instrs = True
@@ -648,7 +794,17 @@ if __name__ == '__main__':
             if isinstance(tlv, Proc): procs[tlv.name] = tlv
             else: gvars[tlv.name] = tlv
         if args.execute:
-            execute(gvars, procs, '@main', (), **kwargs)
+            if args.engine == 'threaded':
+                import tacvm
+                tacvm.execute(gvars, procs, '@main', (), memoize=args.memoize and args.memo_size,
+                              show_memo=args.verbosity > 0,
+                              profile=args.profile and tacvm.profile_path(srcfile),
+                              **kwargs)
+            elif args.engine == 'compiled':
+                import tac2py
+                tac2py.execute(gvars, procs, '@main', (), **kwargs)
+            else:
+                execute(gvars, procs, '@main', (), **kwargs)
         elif args.verbosity > 0:
             for gvar in gvars.values(): print(gvar)
             for proc in procs.values(): print(proc)
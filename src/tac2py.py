@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+"""
+Compile TAC procedures to native Python functions
+
+Every proc is turned into the source of a Python function: the basic
+blocks found by cfg.infer become the states of a `while' loop,
+temporaries become Python locals and phis become parallel assignments
+on the edges that reach them. The source is then exec'd so that the
+procs of a program call each other directly.
+
+The generated code trusts its input: the argument count checks of
+tac.execute are not repeated.
+"""
+
+import hashlib
+import json
+
+import tac
+import cfg as cfglib
+
+# ------------------------------------------------------------------------------
+
+_mask = tac.full_mask
+_sign = tac.sign_mask
+
+# Binary operators whose result can leave [0, 2^64) and must be wrapped
+_wrapped_binops = {'add': '+', 'sub': '-', 'mul': '*'}
+# Binary operators that keep their operands in range
+_plain_binops = {'and': '&', 'or': '|', 'xor': '^'}
+# The remaining binary operators go through tac.binops
+_helper_binops = {'div', 'mod', 'shl', 'shr'}
+
+_jump_tests = {
+    'jz':   '{0} == 0',
+    'jnz':  '{0} != 0',
+    'jl':   f'{{0}} >= {_sign}',
+    'jle':  f'{{0}} == 0 or {{0}} >= {_sign}',
+    'jnl':  f'{{0}} < {_sign}',
+    'jnle': f'0 < {{0}} < {_sign}',
+}
+
+# Source and code objects of the procs compiled so far, keyed by
+# `proc_key'
+_code_cache = dict()
+
+
+def proc_key(proc):
+    """Hash of the name, arguments and body of `proc'"""
+    text = json.dumps(proc.js_obj, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def mangle(proc_name):
+    """Python identifier of the function compiled from a proc"""
+    return f'p_{proc_name[1:]}'
+
+
+def _copy_proc(proc):
+    """Copy of `proc' that cfg.infer can modify freely"""
+    body = [tac.Instr(i.dest, i.opcode,
+                      (dict(i.arg1) if isinstance(i.arg1, dict) else i.arg1,
+                       i.arg2))
+            for i in proc.body]
+    if not body or body[0].opcode != 'label':
+        body.insert(0, tac.Instr(None, 'label', ('%.Lentry', None)))
+    return tac.Proc(proc.name, proc.t_args, body)
+
+
+def _phi_args(instr, preds):
+    """The arguments of a phi whose label is in `preds'. The others come
+    from blocks that no longer jump to the phi (e.g. the unreachable ones
+    dropped by cfg.linearize) and are never used."""
+    # cfg.normalize_labels turns the phi arguments into (label, temp) pairs
+    args = instr.arg1.items() if isinstance(instr.arg1, dict) else instr.arg1
+    return {lab: t for lab, t in args if lab in preds}
+
+
+class _ProcCompiler:
+    """Generates the Python source for a single proc"""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.locals = dict()
+        self.lines = []
+        self.falls_off = False
+
+    def local(self, tmp):
+        if tmp not in self.locals:
+            self.locals[tmp] = f't{len(self.locals)}'
+        return self.locals[tmp]
+
+    def read(self, arg):
+        if isinstance(arg, int): return str(tac.twoc(arg))
+        if arg.startswith('@'): return f'g_{arg[1:]}.value'
+        return self.local(arg)
+
+    def write(self, dest):
+        if dest.startswith('@'): return f'g_{dest[1:]}.value'
+        return self.local(dest)
+
+    def emit(self, depth, line):
+        self.lines.append('    ' * depth + line)
+
+    def expr(self, instr):
+        """Python expression computed by a non-jump instruction"""
+        op = instr.opcode
+        if op == 'const': return str(tac.twoc(instr.arg1))
+        if op == 'copy': return self.read(instr.arg1)
+        if op == 'neg': return f'-{self.read(instr.arg1)} & {_mask}'
+        if op == 'not': return f'{self.read(instr.arg1)} ^ {_mask}'
+        a, b = self.read(instr.arg1), self.read(instr.arg2)
+        if op in _wrapped_binops:
+            return f'({a} {_wrapped_binops[op]} {b}) & {_mask}'
+        if op in _plain_binops:
+            return f'{a} {_plain_binops[op]} {b}'
+        if op in _helper_binops:
+            return f'_{op}({a}, {b})'
+        raise ValueError(f'Cannot compile opcode {op}')
+
+    def emit_edge(self, depth, lab_from, lab_to):
+        """Move along the edge `lab_from' -> `lab_to', resolving the phis
+        at the start of `lab_to'"""
+        dests, srcs = [], []
+        for instr, args in self.phis[lab_to]:
+            if lab_from not in args:
+                self.emit(depth, f'raise RuntimeError("cannot resolve phi: '
+                                 f'came from {lab_from}, can only handle '
+                                 f'[{",".join(args.keys())}]")')
+                return
+            dests.append(self.write(instr.dest))
+            srcs.append(self.read(args[lab_from]))
+        if dests:
+            self.emit(depth, f'{", ".join(dests)} = {", ".join(srcs)}')
+        if lab_from != self.proc.name:
+            self.emit(depth, f'_b = {self.block_ids[lab_to]}')
+            self.emit(depth, 'continue')
+
+    def emit_call(self, depth, instr):
+        callee, nargs = instr.arg1, instr.arg2 or 0
+        args = ', '.join(f'_p{i}' for i in range(1, nargs + 1))
+        if callee == '@__bx_print_int':
+            self.emit(depth, '_print_int(_p1)')
+        elif callee == '@__bx_print_bool':
+            self.emit(depth, '_print_bool(_p1)')
+        elif instr.dest:
+            self.emit(depth, f'{self.write(instr.dest)} = {mangle(callee)}({args})')
+        else:
+            self.emit(depth, f'{mangle(callee)}({args})')
+
+    def emit_block(self, depth, bl):
+        for instr in bl.body:
+            op = instr.opcode
+            if op == 'phi':
+                if all(instr is not phi for phi, _ in self.phis[bl.label]):
+                    raise ValueError(f'phi not at the start of {bl.label}: {instr}')
+            elif op == 'nop':
+                pass
+            elif op == 'param':
+                self.emit(depth, f'_p{instr.arg1} = {self.read(instr.arg2)}')
+            elif op == 'call':
+                self.emit_call(depth, instr)
+            else:
+                self.emit(depth, f'{self.write(instr.dest)} = {self.expr(instr)}')
+        for instr in bl.jumps:
+            op = instr.opcode
+            if op == 'ret':
+                self.emit(depth, 'return' if instr.arg1 is None else
+                                 f'return {self.read(instr.arg1)}')
+                return
+            if op == 'jmp':
+                self.emit_edge(depth, bl.label, instr.arg1)
+                return
+            test = _jump_tests[op].format(self.read(instr.arg1))
+            self.emit(depth, f'if {test}:')
+            self.emit_edge(depth + 1, bl.label, instr.arg2)
+        # falling off the end of the proc
+        self.falls_off = True
+        self.emit(depth, 'print("// " + _desc + " --> NONE")')
+        self.emit(depth, 'return')
+
+    def compile(self):
+        proc = _copy_proc(self.proc)
+        # the labels are kept, so that the phi arguments of blocks that are
+        # gone cannot be taken for those of a renumbered block
+        cfg = cfglib.infer(proc, rename=False)
+        self.block_ids = {lab: i for i, lab in enumerate(cfg.blocks())}
+        self.phis = dict()
+        for bl in cfg.nodes():
+            preds = set(cfg.predecessors(bl.label))
+            if bl.label == cfg.lab_entry: preds.add(proc.name)
+            lead = []
+            for instr in bl.body:
+                if instr.opcode != 'phi': break
+                lead.append((instr, _phi_args(instr, preds)))
+            self.phis[bl.label] = lead
+        params = [self.local(t) for t in proc.t_args]
+        self.emit_edge(1, proc.name, cfg.lab_entry)
+        self.emit(1, f'_b = {self.block_ids[cfg.lab_entry]}')
+        self.emit(1, 'while True:')
+        for i, bl in enumerate(cfg.nodes()):
+            self.emit(2, f'{"if" if i == 0 else "elif"} _b == {self.block_ids[bl.label]}:')
+            self.emit_block(3, bl)
+        header = [f'def {mangle(proc.name)}({", ".join(params)}):']
+        if self.falls_off:
+            desc = ','.join(f'{t}={{{self.local(t)}}}' for t in proc.t_args)
+            header.append(f'    _desc = f"{proc.name}({desc})"')
+        return '\n'.join(header + self.lines) + '\n'
+
+
+def compile_proc(proc):
+    """Return the Python source and code object for `proc', reusing the
+    cached ones if this exact proc was compiled before"""
+    key = proc_key(proc)
+    if key not in _code_cache:
+        source = _ProcCompiler(proc).compile()
+        code = compile(source, f'<tac {proc.name}>', 'exec')
+        _code_cache[key] = (source, code)
+    return _code_cache[key]
+
+def _missing_proc(proc_name):
+    """Stands for a proc that the program calls but does not define"""
+    def missing(*args):
+        raise KeyError(proc_name)
+    return missing
+
+# ------------------------------------------------------------------------------
+
+
+class Program:
+    """A TAC program compiled to Python functions"""
+
+    def __init__(self, gvars, procs, **kwargs):
+        only_decimal = kwargs.get('only_decimal', True)
+        self.namespace = {f'_{op}': tac.binops[op] for op in _helper_binops}
+        if only_decimal:
+            self.namespace['_print_int'] = lambda u: print(str(tac.untwoc(u)))
+        else:
+            self.namespace['_print_int'] = \
+                lambda u: print(f'{tac.untwoc(u): 20d}  0x{u:016x}  0b{u:064b}')
+        self.namespace['_print_bool'] = \
+            lambda u: print('false' if u == 0 else 'true')
+        for name, gvar in gvars.items():
+            self.namespace[f'g_{name[1:]}'] = gvar
+        # calls to undefined procs fail when they are made, with the same
+        # KeyError as in tac.execute
+        for proc in procs.values():
+            for instr in proc.body:
+                if instr.opcode == 'call' and instr.arg1 not in procs and \
+                        not instr.arg1.startswith('@__bx_print'):
+                    self.namespace[mangle(instr.arg1)] = _missing_proc(instr.arg1)
+        self.sources = dict()
+        for name, proc in procs.items():
+            source, code = compile_proc(proc)
+            self.sources[name] = source
+            exec(code, self.namespace)
+
+    def __getitem__(self, proc_name):
+        """The Python function compiled from the given proc"""
+        return self.namespace[mangle(proc_name)]
+
+
+def execute(gvars, procs, proc_name, args, **kwargs):
+    """Counterpart of tac.execute that runs the compiled procs"""
+    return Program(gvars, procs, **kwargs)[proc_name](*args)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Run TAC by compiling it to Python')
+    ap.add_argument('files', metavar='FILE', type=str, nargs='*',
+                    help='A TAC file (.tac or .tac.json)')
+    ap.add_argument('-v', dest='verbosity', default=0, action='count',
+                    help='increase verbosity')
+    ap.add_argument('-S', '--show-source', dest='show_source',
+                    action='store_true', default=False,
+                    help='Print the generated Python source')
+    ap.add_argument('--no-exec', dest='execute', action='store_false',
+                    default=True,
+                    help='Do not run the compiled program')
+    args = ap.parse_args()
+    for srcfile in args.files:
+        gvars, procs = dict(), dict()
+        for tlv in tac.load_tac(srcfile):
+            if isinstance(tlv, tac.Proc): procs[tlv.name] = tlv
+            else: gvars[tlv.name] = tlv
+        prog = Program(gvars, procs, only_decimal=args.verbosity <= 1)
+        if args.show_source:
+            for source in prog.sources.values(): print(source)
+        if args.execute:
+            prog['@main']()
@@ -7,6 +7,11 @@ from ssagen import *
 from tac import *
 import copy
 
+from cse import is_ssa
+from defuse import DefUse, operands
+from dom_tree import EXIT, DomTree, ReverseCFG, dominance_frontiers
+from ssa_min import UnionFind
+
 
 def DSE(cfg: CFG) -> CFG:
     """
@@ -15,8 +20,7 @@ def DSE(cfg: CFG) -> CFG:
     modified = True
     while modified:
         modified = False
-        livein, liveout = dict(), dict()
-        recompute_liveness(cfg, livein, liveout)
+        liveout = Liveness(cfg).liveout
 
         block_list = []
         for block_label, block in cfg._blockmap.items():
@@ -81,6 +85,183 @@ def GCP(cfg: CFG) -> CFG:
     return cfg
 
 
+def copy_propagation(cfg: CFG, stats=None, tree: DomTree = None) -> CFG:
+    """
+    Global copy propagation on a cfg in strict SSA form. Every copy
+    `%a = copy %b' (or of an immediate) is recorded in a union-find, which
+    resolves the chains of copies; then the operands, jumps and phi
+    arguments are rewritten and the copies deleted in one sweep, in
+    place. Copies from or to globals are kept, since globals are not
+    renamed. A cfg that is not in SSA form is left unchanged. `tree' can
+    give the DomTree of the cfg.
+    """
+    uf = UnionFind()
+    copies = set()
+    if is_ssa(cfg, tree):
+        for instr in cfg.instrs():
+            if instr.opcode != 'copy' or not instr.dest.startswith('%'): continue
+            if isinstance(instr.arg1, str) and not instr.arg1.startswith('%'): continue
+            uf.union(instr.dest, instr.arg1)
+            copies.add(instr)
+    for block in cfg.nodes():
+        if not copies: break
+        body = []
+        for instr in block.body:
+            if instr in copies: continue
+            if instr.opcode == 'phi':
+                instr.arg1 = {label: uf.find(t) for label, t in instr.arg1.items()}
+            else:
+                rewrite_use_temps_nonphi(instr, uf.find)
+            body.append(instr)
+        block.body = body
+        for instr in block.jumps:
+            rewrite_use_temps_nonphi(instr, uf.find)
+    if stats is not None:
+        stats['copies_removed'] = len(copies)
+    return cfg
+
+
+def _is_root(instr: Instr) -> bool:
+    """Whether an instruction other than a jump must be kept even if its
+    result is never read: calls, params, rets, writes to globals and the
+    divisions, which can trap"""
+    if instr.opcode in ('div', 'mod', 'ret'): return True
+    if instr.dest and instr.dest.startswith('@'): return True
+    props = opcode_props.get(instr.opcode, 0)
+    return bool(props & OpProp.SIDE_EFFECT and not props & OpProp.JUMP)
+
+
+def _is_branch(block) -> bool:
+    """Whether the jumps of `block' include a conditional jump"""
+    return any(opcode_props.get(jmp.opcode, 0) & OpProp.COND_JUMP
+               for jmp in block.jumps)
+
+
+def dce(cfg: CFG, remove_branches=False, stats=None,
+        du: DefUse = None, tree: DomTree = None) -> CFG:
+    """
+    Aggressive dead code elimination on a cfg in strict SSA form. The
+    instructions with side effects and the jumps are marked live, then
+    the definitions of the operands of live instructions, following the
+    def-use index backwards; everything else is deleted in one sweep.
+
+    With `remove_branches', only the conditional jumps that a live
+    instruction is control dependent on (found with the postdominance
+    frontiers) are live, or those that decide which edge reaches a live
+    phi; unconditional jumps carry no control dependence. The other
+    conditional jumps are replaced by a `jmp' to the immediate
+    postdominator of their block, and the blocks that are no longer
+    reachable are removed, so loops and branches without live
+    instructions disappear. A branch is kept if its block can reach a
+    block that never exits, or if the postdominator has live phis and
+    is not already a successor of the block, since they would lack an
+    argument for the new edge.
+
+    A cfg that is not in SSA form goes through DSE instead. `du' and
+    `tree' can give the DefUse and DomTree of the cfg.
+    """
+    if not is_ssa(cfg, tree):
+        return DSE(cfg)
+    du = du or DefUse(cfg)
+    marked, live_jumps = set(), set()
+    work = []
+
+    def mark(instr):
+        if instr not in marked:
+            marked.add(instr)
+            work.append(instr)
+
+    def mark_jumps(label):
+        if label in live_jumps or label not in cfg._blockmap: return
+        live_jumps.add(label)
+        for jmp in cfg[label].jumps: mark(jmp)
+
+    def mark_control(label):
+        """Mark the branches that decide whether `label' is executed"""
+        for label_ctrl in rdf.get(label, ()):
+            mark_jumps(label_ctrl)
+
+    branches = []
+    if remove_branches:
+        rcfg = ReverseCFG(cfg)
+        ptree = DomTree(rcfg)
+        rdf = dominance_frontiers(rcfg, ptree)
+        for block in cfg.nodes():
+            if not _is_branch(block): continue
+            label = block.label
+            ipdom = ptree.idom.get(label)
+            if ipdom in (None, EXIT) or \
+                    not all(label_next in ptree for label_next in cfg.successors(label)):
+                mark_jumps(label)
+            else:
+                branches.append(label)
+    for block in cfg.nodes():
+        for instr in block.body:
+            if _is_root(instr): mark(instr)
+        if not remove_branches:
+            mark_jumps(block.label)
+        else:
+            for jmp in block.jumps:
+                if _is_root(jmp): mark(jmp)
+    live_phis = dict()
+    while work:
+        while work:
+            instr = work.pop()
+            for t in operands(instr):
+                definition = du.definition(t)
+                if definition is not None: mark(definition)
+            if not remove_branches: continue
+            label = du.block_of[instr]
+            if instr.opcode != 'jmp':
+                mark_control(label)
+            if instr.opcode == 'phi':
+                live_phis[label] = True
+                for label_prev in instr.arg1:
+                    # the branch of the predecessor, if it has one, picks
+                    # the edge; otherwise the branches it depends on do
+                    if label_prev in cfg._blockmap and _is_branch(cfg[label_prev]):
+                        mark_jumps(label_prev)
+                    else:
+                        mark_control(label_prev)
+        # the dead branches that cannot jump to their postdominator
+        for label in branches:
+            if label in live_jumps: continue
+            ipdom = ptree.idom[label]
+            if live_phis.get(ipdom) and ipdom not in cfg._fwd[label]:
+                mark_jumps(label)
+    removable = {label for label in branches if label not in live_jumps}
+
+    counts = {'instrs_removed': 0, 'branches_removed': 0, 'blocks_removed': 0}
+    for block in cfg.nodes():
+        body = [instr for instr in block.body if instr in marked]
+        counts['instrs_removed'] += len(block.body) - len(body)
+        block.body = body
+        if block.label in removable and block.label not in live_jumps:
+            ipdom = ptree.idom[block.label]
+            if [(j.opcode, j.arg1) for j in block.jumps] != [('jmp', ipdom)]:
+                counts['branches_removed'] += 1
+            for label_next in list(cfg.successors(block.label)):
+                cfg.remove_edge(block.label, label_next)
+            block.jumps = [Instr(None, 'jmp', (ipdom,))]
+            cfg.add_edge(block.label, ipdom)
+    if counts['branches_removed']:
+        reached = set(reachable(cfg))
+        for label in list(cfg.blocks()):
+            if label not in reached:
+                counts['instrs_removed'] += len(cfg[label].body)
+                cfg.remove_node(cfg[label])
+                counts['blocks_removed'] += 1
+        for block in cfg.nodes():
+            preds = set(cfg.predecessors(block.label))
+            if block.label == cfg.lab_entry: preds.add(cfg.proc_name)
+            for instr in block.body:
+                if instr.opcode != 'phi': break
+                instr.arg1 = {label: t for label, t in instr.arg1.items() if label in preds}
+    if stats is not None:
+        stats.update(counts)
+    return cfg
+
+
 def optimize_decl(tac_proc: Union[Gvar, Proc]) -> None:
     """
     Optimize a declaration. First perform DSE as many times as necessary,
@@ -91,7 +272,7 @@ def optimize_decl(tac_proc: Union[Gvar, Proc]) -> None:
 
     cfg = DSE(cfg)
 
-    cfg = GCP(tac_proc, cfg)
+    cfg = GCP(cfg)
     linearize(tac_proc, cfg)
 
 
@@ -89,6 +89,23 @@ class Proc:
     self.body = body or []
     self.args = tuple(args)
 
+  @property
+  def body(self):
+    return self._body
+
+  @body.setter
+  def body(self, body):
+    self._body = body
+    self._tables = None
+
+  def tables(self):
+    """The ProcTables of the body, shared by all the calls to this proc.
+    They are rebuilt when the body is replaced or changes length; other
+    in-place edits of the body must reassign it."""
+    if self._tables is None or not self._tables.valid_for(self._body):
+      self._tables = ProcTables(self)
+    return self._tables
+
   @staticmethod
   def load(js_obj):
     name = js_obj.get('proc', None)
@@ -364,6 +381,31 @@ class TempMap(dict):
       else:
         super().__setitem__(tmp, val)
 
+class ProcTables:
+  """Decoded form of a proc body used by the interpreter:
+  - labels: maps each label to the index of the spot right after it
+  - targets: the index to jump to for every jump instruction (None for
+    other instructions and for unknown destinations)"""
+
+  def __init__(self, proc):
+    body = proc.body
+    self._key = (id(body), len(body))
+    self.labels = dict()
+    for i, instr in enumerate(body):
+      if instr.opcode != 'label': continue
+      if instr.arg1 in self.labels:
+        raise RuntimeError(f'Reused label {instr.arg1}')
+      self.labels[instr.arg1] = i + 1 # spot right after the label
+    self.targets = [None] * len(body)
+    for i, instr in enumerate(body):
+      if instr.opcode == 'jmp':
+        self.targets[i] = self.labels.get(instr.arg1)
+      elif instr.opcode in jumps:
+        self.targets[i] = self.labels.get(instr.arg2)
+
+  def valid_for(self, body):
+    return self._key == (id(body), len(body))
+
 def execute(gvars, procs, proc_name, args, **kwargs):
   show_proc = kwargs.get('show_proc', False)
   show_instr = kwargs.get('show_instr', False)
@@ -380,12 +422,7 @@ def execute(gvars, procs, proc_name, args, **kwargs):
   proc_desc = f'{proc_name}({",".join(k + "=" + str(v) for k, v in values.items())})'
   if show_proc: print(f'// {indent}entering {proc_desc}')
 
-  labels = dict()
-  for i, instr in enumerate(proc.body):
-    if instr.opcode != 'label': continue
-    if instr.arg1 in labels:
-      raise RuntimeError(f'Reused label {instr.arg1}')
-    labels[instr.arg1] = i + 1 # spot right after the label
+  targets = proc.tables().targets
 
   pc = 0
   params = []
@@ -396,14 +433,14 @@ def execute(gvars, procs, proc_name, args, **kwargs):
     if instr.opcode == 'nop' or instr.opcode == 'label':
       pc += 1
     elif instr.opcode == 'jmp':
-      if instr.arg1 not in labels:
+      if targets[pc] is None:
         raise RuntimeError(f'Unknown jump destination {instr.arg1}')
-      pc = labels[instr.arg1]
+      pc = targets[pc]
     elif instr.opcode in jumps:
       k = values[instr.arg1]
-      if instr.arg2 not in labels:
+      if targets[pc] is None:
         raise RuntimeError(f'Unknown jump destination {instr.arg2}')
-      pc = labels[instr.arg2] if jumps[instr.opcode](k) else pc + 1
+      pc = targets[pc] if jumps[instr.opcode](k) else pc + 1
     elif instr.opcode == 'const':
       if not isinstance(instr.arg1, int):
         print(f'Missing or bad argument: {instr.arg1}')
@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+
+"""
+Decoded TAC execution engine
+
+Each Proc is decoded once into a list of closures, one per instruction,
+with operands and jump targets already resolved. The closures are then
+run by a tight dispatch loop. tac.execute remains the reference
+interpreter; both engines must print the same output.
+
+A running proc keeps its state in a register file: a flat list whose
+layout is fixed when the proc is decoded (see `Layout'). TAC calls do
+not recurse in Python: the caller's frame is pushed on an explicit
+stack, so the depth of TAC recursion is only bounded by memory.
+"""
+
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import tac
+
+# ------------------------------------------------------------------------------
+
+_mask = tac.full_mask
+_sign = tac.sign_mask
+
+# Negative program counters stop the dispatch loop
+_RETURNED = -1
+_FELL_OFF = -2
+_CALL = -3
+
+# Binary operators on 64-bit words that do not need the untwoc/twoc
+# round trip of tac.binops
+fast_binops = {
+    'add': (lambda u, v: (u + v) & _mask),
+    'sub': (lambda u, v: (u - v) & _mask),
+    'mul': (lambda u, v: (u * v) & _mask),
+    'and': (lambda u, v: u & v),
+    'or':  (lambda u, v: u | v),
+    'xor': (lambda u, v: u ^ v),
+}
+for _op, _fn in tac.binops.items():
+    fast_binops.setdefault(_op, _fn)
+fast_unops = {
+    'neg': (lambda u: -u & _mask),
+    'not': (lambda u: ~u & _mask),
+}
+fast_jumps = {
+    'jz':   (lambda k: k == 0),
+    'jnz':  (lambda k: k != 0),
+    'jl':   (lambda k: k >= _sign),
+    'jle':  (lambda k: k == 0 or k >= _sign),
+    'jnl':  (lambda k: k < _sign),
+    'jnle': (lambda k: 0 < k < _sign),
+}
+
+
+class Layout:
+    """Register file layout of a proc. The registers are, in order:
+    - the arguments of the proc
+    - the other temporaries of the proc
+    - one register per distinct immediate operand, holding its value
+    - the outgoing parameters set by `param'
+    - the return value
+    Globals do not get a register: they are read and written through
+    their Gvar, resolved once at decoding time."""
+
+    def __init__(self, proc):
+        self.slots = dict()
+        for t in proc.t_args:
+            self._add(t)
+        self.nargs = len(self.slots)
+        consts, nparams = [], 0
+        for instr in proc.body:
+            if instr.opcode == 'label': continue
+            if instr.opcode == 'param':
+                nparams = max(nparams, instr.arg1)
+            for t in (instr.dest, instr.arg1, instr.arg2):
+                if self._is_temp(t): self._add(t)
+                elif isinstance(t, int) and instr.opcode not in ('const', 'param', 'call'):
+                    consts.append(t)
+            if instr.opcode == 'param' and isinstance(instr.arg2, int):
+                consts.append(instr.arg2)
+            if instr.opcode == 'phi':
+                for t in instr.arg1.values():
+                    if self._is_temp(t): self._add(t)
+                    elif isinstance(t, int): consts.append(t)
+        self.consts = dict()
+        for k in consts:
+            self.consts.setdefault(tac.twoc(k), len(self.slots) + len(self.consts))
+        self.params = len(self.slots) + len(self.consts)
+        self.retval = self.params + nparams
+        self.template = [None] * (self.retval + 1 - self.nargs)
+        for k, i in self.consts.items():
+            self.template[i - self.nargs] = k
+
+    @staticmethod
+    def _is_temp(thing):
+        return isinstance(thing, str) and thing.startswith('%') and \
+            not thing.startswith('%.L')
+
+    def _add(self, tmp):
+        self.slots.setdefault(tmp, len(self.slots))
+
+    def slot(self, arg):
+        """Register holding `arg', or None for a global"""
+        if isinstance(arg, int): return self.consts[tac.twoc(arg)]
+        return self.slots.get(arg)
+
+
+def pure_procs(procs):
+    """Return the set of names of the procs whose result only depends on
+    their arguments: they do not read or write globals, do not print,
+    cannot fall off their end and only call pure procs"""
+    calls = dict()
+    for name, proc in procs.items():
+        body = proc.body
+        if not body or body[-1].opcode not in ('ret', 'jmp'):
+            continue
+        callees = set()
+        for instr in body:
+            if instr.opcode == 'call':
+                callees.add(instr.arg1)
+            elif any(isinstance(t, str) and t.startswith('@')
+                     for t in (instr.dest, instr.arg1, instr.arg2)):
+                break
+            elif instr.opcode == 'phi' and \
+                    any(isinstance(t, str) and t.startswith('@')
+                        for t in instr.arg1.values()):
+                break
+        else:
+            calls[name] = callees
+    # greatest fixpoint, so that recursive procs can be pure
+    pure = set(calls)
+    changed = True
+    while changed:
+        changed = False
+        for name in list(pure):
+            if not calls[name] <= pure:
+                pure.remove(name)
+                changed = True
+    return pure
+
+
+class Memo:
+    """Bounded LRU cache of the results of pure procs, keyed by
+    (proc name, arguments)"""
+
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def lookup(self, key):
+        """Return (True, result) for a cached call, (False, None) otherwise"""
+        results = self.results
+        if key in results:
+            self.hits += 1
+            results.move_to_end(key)
+            return True, results[key]
+        self.misses += 1
+        return False, None
+
+    def store(self, key, result):
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {'size': self.size, 'entries': len(self.results),
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class Code:
+    """A decoded proc"""
+
+    def __init__(self, proc, layout, ops):
+        self.proc = proc
+        self.layout = layout
+        self.ops = ops
+        self.pure = False
+        # profiling (see Machine): the control-flow edges counted by the
+        # ops, their counters, and the dynamic totals of the proc
+        self.sites = []
+        self.counts = []
+        self.calls = 0
+        self.self_time = 0.0
+
+    def frame(self, args):
+        """Fresh register file for a call with the given arguments. Extra
+        arguments are ignored, as in tac.execute, but missing ones are an
+        error: they would shift every register of the template."""
+        nargs = self.layout.nargs
+        if len(args) != nargs:
+            if len(args) < nargs:
+                raise RuntimeError(f'Bad number of arguments to {self.proc.name}(): '
+                                   f'expected {nargs}, got {len(args)}')
+            args = args[:nargs]
+        return [*args, *self.layout.template]
+
+    def describe(self, args):
+        return f'{self.proc.name}({",".join(k + "=" + str(v) for k, v in zip(self.proc.t_args, args))})'
+
+
+class Machine:
+    """Decodes and runs the procs of a single TAC program.
+
+    With memoize=N, the results of the calls to pure procs (see
+    `pure_procs') are kept in an LRU cache of N entries, available
+    as `memo'.
+
+    With profile=True, the decoded procs count the calls, the time spent
+    in each proc and the traversals of the control-flow edges; see
+    `profile_data'. Only the jumps and the labels reached by falling
+    through are counted, the other counters are derived from these."""
+
+    def __init__(self, gvars, procs, **kwargs):
+        self.gvars = gvars
+        self.procs = procs
+        self.show_proc = kwargs.get('show_proc', False)
+        self.only_decimal = kwargs.get('only_decimal', True)
+        memoize = kwargs.get('memoize', None)
+        self.memo = Memo(memoize) if memoize else None
+        self.pure = pure_procs(procs) if memoize else set()
+        self.profile = kwargs.get('profile', False)
+        self.code = dict()
+        # (callee, args, write, return pc) of the call being made
+        self.pending = None
+
+    # --------------------------------------------------------------------------
+    # decoding
+
+    def _reader(self, lay, arg):
+        """Return a function that reads `arg' from a register file"""
+        i = lay.slot(arg)
+        if i is None:
+            g = self.gvars[arg]
+            return lambda r: g.value
+        return lambda r: r[i]
+
+    def _writer(self, lay, dest):
+        """Return a function that writes to `dest' in a register file"""
+        i = lay.slot(dest)
+        if i is None:
+            g = self.gvars[dest]
+            def write(r, val): g.value = val
+        else:
+            def write(r, val): r[i] = val
+        return write
+
+    def decode(self, proc_name):
+        """Return the Code for the given proc, decoding it the first time
+        it is requested"""
+        code = self.code.get(proc_name)
+        if code is None:
+            code = self._decode(self.procs[proc_name])
+            code.pure = proc_name in self.pure
+            self.code[proc_name] = code
+        return code
+
+    def _decode(self, proc):
+        body = proc.body
+        tables = proc.tables()
+        labels, edges = tables.labels, tables.edges
+        lay = Layout(proc)
+        ops = []
+        # `cur' is the label of the current block, `pred' the one of the
+        # block that falls through into it
+        pred, cur = None, proc.name
+        for pc, instr in enumerate(body):
+            if instr.opcode == 'phi':
+                if pc > 0 and body[pc - 1].opcode == 'phi':
+                    # already handled by the first phi of the group
+                    ops.append(lambda r, nxt=pc + 1: nxt)
+                    continue
+                if cur not in edges or labels[cur] != pc:
+                    raise RuntimeError(f'phi not at the start of {cur}: {instr}')
+                # only reached by falling through into the block
+                ops.append(self._decode_edge(lay, edges, pred, cur, labels))
+                continue
+            if instr.opcode == 'label':
+                pred, cur = cur, instr.arg1
+            ops.append(self._decode_instr(lay, instr, pc + 1, labels, edges, cur))
+        ops.append(lambda r: _FELL_OFF)
+        code = Code(proc, lay, ops)
+        if self.profile:
+            self._count_edges(code)
+        return code
+
+    @staticmethod
+    def _regions(body, name):
+        """Name of the block each instruction of `body' belongs to: the
+        last label of the group of labels that starts it, or `name'
+        before the first label"""
+        regions, cur = [], name
+        for pc, instr in enumerate(body):
+            if instr.opcode == 'label':
+                end = pc
+                while end + 1 < len(body) and body[end + 1].opcode == 'label':
+                    end += 1
+                cur = body[end].arg1
+            regions.append(cur)
+        return regions
+
+    def _count_edges(self, code):
+        """Wrap the jumps and the labels ending a group of labels so
+        that they count the edges they traverse"""
+        body, ops, counts = code.proc.body, code.ops, code.counts
+        regions = self._regions(body, code.proc.name)
+        group = dict()
+        for pc, instr in enumerate(body):
+            if instr.opcode == 'label':
+                group[instr.arg1] = regions[pc]
+        for pc, instr in enumerate(body):
+            op = instr.opcode
+            if op == 'label':
+                if pc + 1 < len(body) and body[pc + 1].opcode == 'label':
+                    continue
+                start = pc
+                while start > 0 and body[start - 1].opcode == 'label':
+                    start -= 1
+                lab_from = regions[start - 1] if start > 0 else code.proc.name
+                lab_to, taken = regions[pc], False
+            elif op == 'jmp' or op in fast_jumps:
+                lab_to = group.get(instr.arg1 if op == 'jmp' else instr.arg2)
+                if lab_to is None: continue
+                lab_from, taken = regions[pc], True
+            else:
+                continue
+            k = len(counts)
+            code.sites.append((pc, lab_from, lab_to))
+            counts.append(0)
+            ops[pc] = self._counted(ops[pc], counts, k, pc + 1, taken)
+
+    @staticmethod
+    def _counted(op, counts, k, nxt, taken):
+        if not taken:
+            def count_fallthrough(r):
+                counts[k] += 1
+                return op(r)
+            return count_fallthrough
+        def count_taken(r):
+            pc = op(r)
+            if pc != nxt: counts[k] += 1
+            return pc
+        return count_taken
+
+    def _decode_edge(self, lay, edges, lab_from, lab_to, labels):
+        """Return the program counter after the phis at `lab_to' if there
+        is nothing to do when coming from `lab_from', or else a closure that
+        performs the parallel copies of the phis and returns it"""
+        if lab_to not in edges:
+            return labels[lab_to]
+        count, copies = edges[lab_to]
+        tgt = labels[lab_to] + count
+        if lab_from not in copies:
+            return self._fail(f'cannot resolve phi: '
+                              f'came from {lab_from}, '
+                              f'can only handle [{",".join(copies.keys())}]')
+        copies = copies[lab_from]
+        dests = [lay.slot(d) for d, _ in copies]
+        srcs = [lay.slot(s) for _, s in copies]
+        if None in dests or None in srcs:
+            reads = [self._reader(lay, s) for _, s in copies]
+            writes = [self._writer(lay, d) for d, _ in copies]
+            def move(r):
+                vals = [rd(r) for rd in reads]
+                for write, val in zip(writes, vals):
+                    write(r, val)
+                return tgt
+        elif len(copies) == 1:
+            (d,), (s,) = dests, srcs
+            def move(r):
+                r[d] = r[s]
+                return tgt
+        else:
+            pairs = tuple(zip(dests, srcs))
+            def move(r):
+                vals = [r[s] for _, s in pairs]
+                for (d, _), val in zip(pairs, vals):
+                    r[d] = val
+                return tgt
+        return move
+
+    def _decode_instr(self, lay, instr, nxt, labels, edges, cur):
+        op = instr.opcode
+        if op == 'nop' or op == 'label':
+            return lambda r: nxt
+        if op == 'jmp':
+            if instr.arg1 not in labels:
+                return self._fail(f'Unknown jump destination {instr.arg1}')
+            move = self._decode_edge(lay, edges, cur, instr.arg1, labels)
+            if isinstance(move, int):
+                return lambda r: move
+            return move
+        if op in fast_jumps:
+            if instr.arg2 not in labels:
+                return self._fail(f'Unknown jump destination {instr.arg2}')
+            test = fast_jumps[op]
+            move = self._decode_edge(lay, edges, cur, instr.arg2, labels)
+            a = lay.slot(instr.arg1)
+            if isinstance(move, int):
+                tgt = move
+                if a is not None:
+                    def jcc(r):
+                        return tgt if test(r[a]) else nxt
+                else:
+                    ra = self._reader(lay, instr.arg1)
+                    def jcc(r):
+                        return tgt if test(ra(r)) else nxt
+            else:
+                ra = self._reader(lay, instr.arg1)
+                def jcc(r):
+                    return move(r) if test(ra(r)) else nxt
+            return jcc
+        if op == 'const':
+            if not isinstance(instr.arg1, int):
+                print(f'Missing or bad argument: {instr.arg1}')
+                raise RuntimeError
+            k, d = tac.twoc(instr.arg1), lay.slot(instr.dest)
+            if d is not None:
+                def const(r):
+                    r[d] = k
+                    return nxt
+            else:
+                write = self._writer(lay, instr.dest)
+                def const(r):
+                    write(r, k)
+                    return nxt
+            return const
+        if op == 'copy':
+            d, a = lay.slot(instr.dest), lay.slot(instr.arg1)
+            if d is not None and a is not None:
+                def copy(r):
+                    r[d] = r[a]
+                    return nxt
+            else:
+                ra = self._reader(lay, instr.arg1)
+                write = self._writer(lay, instr.dest)
+                def copy(r):
+                    write(r, ra(r))
+                    return nxt
+            return copy
+        if op in fast_binops:
+            fn = fast_binops[op]
+            d, a, b = (lay.slot(instr.dest), lay.slot(instr.arg1),
+                       lay.slot(instr.arg2))
+            if d is not None and a is not None and b is not None:
+                def binop(r):
+                    r[d] = fn(r[a], r[b])
+                    return nxt
+            else:
+                ra, rb = self._reader(lay, instr.arg1), self._reader(lay, instr.arg2)
+                write = self._writer(lay, instr.dest)
+                def binop(r):
+                    write(r, fn(ra(r), rb(r)))
+                    return nxt
+            return binop
+        if op in fast_unops:
+            if instr.arg2 != None:
+                print(f'Unary operator {op} has two arguments!')
+                raise RuntimeError
+            fn = fast_unops[op]
+            ra, write = self._reader(lay, instr.arg1), self._writer(lay, instr.dest)
+            def unop(r):
+                write(r, fn(ra(r)))
+                return nxt
+            return unop
+        if op == 'param':
+            if not isinstance(instr.arg1, int) or instr.arg1 < 1:
+                print(f'Bad argument to param: '
+                      f'expecting int >= 1, got {instr.arg1}')
+            p, ra = lay.params + instr.arg1 - 1, self._reader(lay, instr.arg2)
+            def param(r):
+                r[p] = ra(r)
+                return nxt
+            return param
+        if op == 'call':
+            return self._decode_call(lay, instr, nxt)
+        if op == 'ret':
+            if instr.arg1 == None:
+                return lambda r: _RETURNED
+            ra, rv = self._reader(lay, instr.arg1), lay.retval
+            def ret(r):
+                r[rv] = ra(r)
+                return _RETURNED
+            return ret
+        print(f'Unknown opcode {op}')
+        raise RuntimeError
+
+    def _decode_call(self, lay, instr, nxt):
+        callee, p = instr.arg1, lay.params
+        if callee.startswith('@__bx_print'):
+            if callee == '@__bx_print_int':
+                if self.only_decimal:
+                    show = lambda u: print(str(tac.untwoc(u)))
+                else:
+                    show = lambda u: print(f'{tac.untwoc(u): 20d}  0x{u:016x}  0b{u:064b}')
+            elif callee == '@__bx_print_bool':
+                show = lambda u: print('false' if u == 0 else 'true')
+            else:
+                return self._fail(f'Unknown print() specialization: {callee}')
+            def call_print(r):
+                u = r[p]
+                if u is None:
+                    raise RuntimeError(f'Bad number of arguments to print(): '
+                                       f'expected 1, got 0')
+                show(u)
+                r[p] = None
+                return nxt
+            return call_print
+        nargs = instr.arg2 or 0
+        unset = [None] * nargs
+        write = None if not instr.dest else self._writer(lay, instr.dest)
+        code = None
+        def call(r):
+            nonlocal code
+            args = r[p:p + nargs]
+            if None in args:
+                raise RuntimeError(f'Bad number of arguments to {callee}(): '
+                                   f'expected {nargs}, got {args.index(None)}')
+            r[p:p + nargs] = unset
+            if code is None: code = self.decode(callee)
+            self.pending = (code, args, write, nxt)
+            return _CALL
+        return call
+
+    @staticmethod
+    def _fail(msg):
+        def fail(r):
+            raise RuntimeError(msg)
+        return fail
+
+    # --------------------------------------------------------------------------
+    # execution
+
+    def call(self, proc_name, args):
+        """Run the proc named `proc_name' on `args' and return its result"""
+        show_proc, memo, profile = self.show_proc, self.memo, self.profile
+        # frames of the callers: (code, args, registers, write, return pc)
+        stack = []
+        code = self.decode(proc_name)
+        ops, r = code.ops, code.frame(args)
+        if profile:
+            code.calls += 1
+            start = time.perf_counter()
+        if show_proc: print(f'// entering {code.describe(args)}')
+        pc = 0
+        while True:
+            while pc >= 0:
+                pc = ops[pc](r)
+            if pc == _CALL:
+                callee, callee_args, write, nxt = self.pending
+                if callee.pure and memo is not None:
+                    found, retval = memo.lookup((callee.proc.name, *callee_args))
+                    if found:
+                        if write: write(r, retval)
+                        pc = nxt
+                        continue
+                stack.append((code, args, r, write, nxt))
+                if profile:
+                    now = time.perf_counter()
+                    code.self_time += now - start
+                    callee.calls += 1
+                    start = now
+                code, args = callee, callee_args
+                ops, r = code.ops, code.frame(args)
+                if show_proc:
+                    print(f'// {"  " * len(stack)}entering {code.describe(args)}')
+                pc = 0
+                continue
+            retval = r[code.layout.retval]
+            if pc == _FELL_OFF:
+                print(f'// {"  " * len(stack)}{code.describe(args)} --> NONE')
+            elif show_proc:
+                print(f'// {"  " * len(stack)}{code.describe(args)} --> {retval}')
+            if code.pure and memo is not None:
+                memo.store((code.proc.name, *args), retval)
+            if profile:
+                now = time.perf_counter()
+                code.self_time += now - start
+                start = now
+            if not stack:
+                return retval
+            code, args, r, write, pc = stack.pop()
+            ops = code.ops
+            if write: write(r, retval)
+
+    # --------------------------------------------------------------------------
+    # profiling
+
+    def profile_data(self):
+        """Return the profile collected so far as a JSON-serializable dict:
+        for every proc that was called, the number of calls, its self time
+        in seconds, the number of entries of each block, the number of
+        traversals of each edge [from, to, count] and the number of
+        executed instructions of each opcode. Blocks are named after
+        their label, or after the proc for the code before the first
+        label; labels are not counted as instructions."""
+        data = {'version': 1, 'procs': dict(), 'opcodes': dict(),
+                'instructions': 0}
+        for name, code in self.code.items():
+            if code.calls == 0: continue
+            body = code.proc.body
+            regions = self._regions(body, name)
+            edges, blocks = dict(), dict()
+            if body and body[0].opcode != 'label':
+                blocks[name] = code.calls
+            for (pc, lab_from, lab_to), n in zip(code.sites, code.counts):
+                edges[lab_from, lab_to] = edges.get((lab_from, lab_to), 0) + n
+                blocks[lab_to] = blocks.get(lab_to, 0) + n
+            taken = {pc: n for (pc, _, _), n in zip(code.sites, code.counts)}
+            opcodes, running = dict(), code.calls
+            for pc, instr in enumerate(body):
+                op = instr.opcode
+                if op == 'label':
+                    running = blocks.get(regions[pc], 0)
+                    continue
+                opcodes[op] = opcodes.get(op, 0) + running
+                if op == 'ret':
+                    running = 0
+                elif pc in taken:
+                    running -= taken[pc]
+            total = sum(opcodes.values())
+            data['procs'][name] = {
+                'calls': code.calls,
+                'self_time': code.self_time,
+                'instructions': total,
+                'blocks': blocks,
+                'edges': [[f, t, n] for (f, t), n in edges.items()],
+                'opcodes': opcodes,
+            }
+            for op, n in opcodes.items():
+                data['opcodes'][op] = data['opcodes'].get(op, 0) + n
+            data['instructions'] += total
+        return data
+
+
+def profile_path(srcfile):
+    """Where the profile of the TAC file `srcfile' is written"""
+    for ext in ('.tac.json', '.tac'):
+        if srcfile.endswith(ext):
+            return srcfile[:-len(ext)] + '.profile.json'
+    return srcfile + '.profile.json'
+
+
+def execute(gvars, procs, proc_name, args, **kwargs):
+    """Drop-in replacement for tac.execute using the decoded engine.
+    Takes the additional keyword arguments `memoize' (see Machine) and
+    `profile', the name of a file where the profile is written as JSON."""
+    profile = kwargs.pop('profile', None)
+    m = Machine(gvars, procs, profile=bool(profile), **kwargs)
+    result = m.call(proc_name, args)
+    if profile:
+        with open(profile, 'w') as fp:
+            json.dump(m.profile_data(), fp, indent=2)
+    if m.memo is not None and kwargs.get('show_memo', False):
+        st = m.memo.stats()
+        print(f'// memo: {st["hits"]} hits, {st["misses"]} misses, '
+              f'{st["evictions"]} evictions, {st["entries"]}/{st["size"]} entries',
+              file=sys.stderr)
+    return result